@@ -0,0 +1,99 @@
+import sys
+import argparse
+import configparser
+from cassandra.cluster import Cluster
+from cassandra.auth import PlainTextAuthProvider
+
+# Batched hourly writer, shared with the Spark job in ../spark
+sys.path.append('../spark')
+import cassandra_sink
+
+
+# Murmur3Partitioner token range
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+
+def token_splits(splits):
+    '''
+    Split the token ring into contiguous (start, end] ranges
+    '''
+    step = (MAX_TOKEN - MIN_TOKEN) // splits
+    bounds = [MIN_TOKEN + i * step for i in range(splits)] + [MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def backfill(session, splits=256, start_split=0, fetch_size=5000,
+             max_batch_rows=100, concurrency=16):
+    '''
+    Copy weather.table_hourly into weather.table_hourly_by_year
+
+    The old table is scanned one token range at a time. A scan returns
+    whole partitions (grid_id, parameter), each in time order, so the rows
+    of one year stay together and are written with
+    cassandra_sink.write_hourly as they stream in. Inserts are idempotent,
+    so an interrupted backfill is resumed with start_split.
+    '''
+    select = session.prepare(
+        "SELECT grid_id, parameter, time, measurement FROM weather.table_hourly "
+        "WHERE token(grid_id, parameter) > ? AND token(grid_id, parameter) <= ?"
+    )
+    select.fetch_size = fetch_size
+
+    ranges = token_splits(splits)
+    total = cassandra_sink.SinkStats()
+    for i in range(start_split, splits):
+        # No key hashes to the minimum token, so (start, end] ranges
+        # cover the whole ring
+        rows = session.execute(select, ranges[i])
+        cassandra_sink.write_hourly(
+            session, ((row.grid_id, row.parameter, row.time, row.measurement)
+                      for row in rows),
+            max_batch_rows=max_batch_rows, concurrency=concurrency,
+            stats=total, table='table_hourly_by_year')
+        print('split {}/{} done: {}'.format(i + 1, splits, total))
+    return total
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Copy weather.table_hourly into weather.table_hourly_by_year')
+    parser.add_argument('--splits', type=int, default=256,
+                        help='Token ranges the old table is scanned in')
+    parser.add_argument('--start-split', type=int, default=0,
+                        help='First token range, to resume an interrupted run')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Batches in flight')
+    parser.add_argument('--batch-rows', type=int, default=100,
+                        help='Rows per unlogged single-partition batch')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    # Read in configuration file
+
+    config = configparser.ConfigParser()
+    config.read('../setup.cfg')
+
+    auth_provider = PlainTextAuthProvider(config["cassandra"]["user"],
+                                          config["cassandra"]["password"])
+    if config.has_option("cassandra", "secure_bundle"):
+        cloud_config = {'secure_connect_bundle': config["cassandra"]["secure_bundle"]}
+        cluster = Cluster(cloud=cloud_config, auth_provider=auth_provider)
+    else:
+        cluster = Cluster([config["cassandra"]["dns"]], auth_provider=auth_provider)
+
+    try:
+        session = cluster.connect()
+        stats = backfill(session, args.splits, args.start_split,
+                         max_batch_rows=args.batch_rows,
+                         concurrency=args.concurrency)
+        print('backfill done: {}'.format(stats))
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,54 @@
+import configparser
+from cassandra.cluster import Cluster
+from cassandra.auth import PlainTextAuthProvider
+
+
+def create_tables():
+    '''
+    Create hourly tables in the Cassandra weather keyspace
+
+    table_hourly_by_year adds the year to the partition key, so a grid
+    point's history is split into one bounded partition per year instead
+    of a single partition that grows for 40 years. The web app only reads
+    table_hourly_by_year; history already in table_hourly is copied over
+    with backfill_by_year.py
+    '''
+    commands = (
+        """
+        CREATE TABLE IF NOT EXISTS weather.table_hourly_by_year (
+            grid_id int,
+            parameter text,
+            year int,
+            time timestamp,
+            measurement float,
+            PRIMARY KEY ((grid_id, parameter, year), time)
+        ) WITH CLUSTERING ORDER BY (time ASC);
+        """,
+    )
+
+    # Read in configuration file
+
+    config = configparser.ConfigParser()
+    config.read('../setup.cfg')
+
+    auth_provider = PlainTextAuthProvider(config["cassandra"]["user"],
+                                          config["cassandra"]["password"])
+    if config.has_option("cassandra", "secure_bundle"):
+        cloud_config = {'secure_connect_bundle': config["cassandra"]["secure_bundle"]}
+        cluster = Cluster(cloud=cloud_config, auth_provider=auth_provider)
+    else:
+        cluster = Cluster([config["cassandra"]["dns"]], auth_provider=auth_provider)
+
+    try:
+        session = cluster.connect()
+        print("got connection")
+        for command in commands:
+            session.execute(command)
+            print("executed command")
+    finally:
+        cluster.shutdown()
+        print("closed the connection")
+
+
+if __name__ == '__main__':
+    create_tables()
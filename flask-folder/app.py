@@ -1,14 +1,24 @@
 import googlemaps
 from flask import Flask
-from flask import render_template, request, redirect
-from flask import stream_with_context, Response
+from flask import render_template, request, redirect, abort
+from flask import stream_with_context, Response, jsonify, send_file
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.datastructures import MultiDict
 from sqlalchemy.sql import text
 from flask_cassandra import CassandraCluster
-from datetime import datetime
-from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import groupby
+from collections import deque
+import heapq
+import json
+import re
 from cassandra.cluster import Cluster
 from cassandra.auth import PlainTextAuthProvider
+from grid_lookup import load_grid_index
+from chart_cache import ChartCache
+from geocache import GeocodeCache
+import download_formats
+import rasters
 
 app = Flask(__name__)
 app.config.from_object('config.DevelopmentConfig')
@@ -16,13 +26,19 @@ GoogleMapsKey = app.config["GOOGLEMAPSKEY"]
 GoogleMapsJSKey = app.config["GOOGLEMAPSJSKEY"]
 CassandraUser = app.config["CASSANDRA_USER"]
 CassandraPassword = app.config["CASSANDRA_PASSWORD"]
+CassandraFetchSize = app.config["CASSANDRA_FETCH_SIZE"]
 
 cloud_config= {'secure_connect_bundle': '/Users/evanmorgan/CQL/secure-connect-epa-weather-history.zip'}
 auth_provider = PlainTextAuthProvider(CassandraUser, CassandraPassword)
 
 db = SQLAlchemy(app)
 cluster = Cluster(cloud=cloud_config, auth_provider=auth_provider)
+# Per-worker session and prepared statement, see get_cassandra_session
+cassandra_session = None
+select_hourly = None
 gmaps = googlemaps.Client(key=GoogleMapsKey)
+geocoder = GeocodeCache(gmaps.geocode, app.config["GEOCODE_CACHE_PATH"])
+grid_index = load_grid_index(app.config["GRID_INDEX_PATH"])
 API_url = "https://maps.googleapis.com/maps/api/js?key="\
         + GoogleMapsJSKey + "&callback=initMap"
 
@@ -32,86 +48,246 @@ wind_code = 61103 # 88101  # Federal reference methods
 temp_code = 62101
 humidity_code = 62201
 pm_code = 64101 # 88502  # Non-federal reference methods
+weather_codes = [pressure_code, wind_code, temp_code, humidity_code]
+weather_names = {'pressure': pressure_code, 'wind': wind_code,
+                 'temp': temp_code, 'humidity': humidity_code}
+weather_headers = {pressure_code: "Pressure [mbar]", wind_code: "Wind [mph]",
+                   temp_code: "Temp [F]", humidity_code: "Humidity [%]"}
+# Column names in Parquet/Arrow downloads
+weather_columns = {code: name for name, code in weather_names.items()}
+
+# First year of hourly history in Cassandra
+history_first_year = 1980
+
+# Lattice steps searched around a location, ~10,000 lattice points
+grid_search_radius = 50
 
 # Chicago coordinates as a default
 chi = dict()
 chi['lat'] = 41.8781136
 chi['lon'] = -87.6297982
 
-import models
+
+def get_cassandra_session():
+    '''
+    Return the Cassandra session of this worker process, connecting once
+
+    Gunicorn forks workers after importing the app, so the session is
+    opened lazily in each worker and reused by all of its requests
+    '''
+    global cassandra_session, select_hourly
+    if cassandra_session is None:
+        cassandra_session = cluster.connect("weather")
+        select_hourly = cassandra_session.prepare(
+            "SELECT time, measurement FROM weather.table_hourly_by_year "
+            "WHERE grid_id = ? AND parameter = ? AND year = ? "
+            "AND time >= ? AND time < ?"
+        )
+        select_hourly.fetch_size = CassandraFetchSize
+    return cassandra_session
+
+
+def query_weather_year(session, grid_id, parameter, year, start, end):
+    '''
+    Start the query for the history of weather code (parameter) at grid_id
+    in one year bucket, between start (inclusive) and end (exclusive),
+    without waiting for it
+
+    Returns
+    -------
+    ResponseFuture
+    '''
+    return session.execute_async(select_hourly,
+                                 (int(grid_id), str(parameter), year, start, end))
+
+
+class QueryBudget(object):
+    '''
+    Bound on the hourly queries one request keeps in flight
+
+    A stream may always start the bucket it is about to read; prefetches
+    of the following bucket are only started while fewer than limit
+    queries are in flight. A query counts as in flight until its bucket
+    has been read, so a request holds at most max(limit, streams) first
+    pages at a time.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+
+    def start(self, query, prefetch=False):
+        '''
+        Run query() and count it, or return None for a prefetch over the limit
+        '''
+        if prefetch and self.in_flight >= self.limit:
+            return None
+        self.in_flight += 1
+        return query()
+
+    def done(self):
+        self.in_flight -= 1
+
+
+def weather_year_queries(session, grid_id, parameter, start, end):
+    '''
+    Deferred query_weather_year calls for every year bucket between start
+    and end, in year order
+    '''
+    return [lambda year=year: query_weather_year(session, grid_id, parameter,
+                                                 year, start, end)
+            for year in history_years(start, end)]
+
+
+def iter_weather_records(session, grid_id, parameter, start, end, budget):
+    '''
+    Iterator of (time, parameter, measurement) for weather code (parameter)
+    at grid_id between start and end
+
+    The query of the first year bucket is started right away, so the
+    first pages of several streams are fetched concurrently even though
+    a merge reads the streams one after the other.
+    '''
+    queries = weather_year_queries(session, grid_id, parameter, start, end)
+    first = budget.start(queries[0]) if queries else None
+    return read_weather_years(queries, first, parameter, budget)
+
+
+def read_weather_years(queries, first, parameter, budget):
+    '''
+    Yield the records of the year bucket queries of iter_weather_records,
+    the first of which is already started as first
+
+    Buckets are read in year order and Cassandra returns each one in
+    clustering order, so records come out in time order. The query of
+    bucket N+1 is started (within budget) when reading bucket N begins,
+    and further pages are fetched only as the iteration reaches them.
+    '''
+    prefetched = first
+    for i, query in enumerate(queries):
+        future = prefetched or budget.start(query)
+        prefetched = budget.start(queries[i + 1], prefetch=True)\
+            if i + 1 < len(queries) else None
+        try:
+            for record in future.result():
+                yield record.time, parameter, record.measurement
+        finally:
+            budget.done()
+
+
+def history_years(start, end):
+    '''
+    Years bucketing the hourly history in Cassandra between start and end
+    '''
+    last = (end - timedelta(microseconds=1)).year
+    return range(max(start.year, history_first_year),
+                 min(last, datetime.utcnow().year) + 1)
 
 
-def get_weather_records(session, data, grid_id, parameter):
+def history_range():
     '''
-    Add full historical data for weather code (parameter)
-    at grid_id to a dictionary data
+    Default (start, end) covering the whole hourly history
     '''
-    cql = "SELECT * FROM weather.table_hourly WHERE grid_id = {} AND parameter = '{}'"
-    cql_command = cql.format(grid_id, parameter)
-    print(cql_command)
-    records = list(session.execute(cql_command))
+    return datetime(history_first_year, 1, 1), datetime(datetime.utcnow().year + 1, 1, 1)
 
-    for record in records:
-        time = record.time.strftime('%Y-%m-%d %H:%M')
-        if not data.get(time):
-            data[time] = dict()
-        data[time][parameter] = record.measurement
 
+def get_weather_data(grid_id, codes=None, start=None, end=None):
+    '''
+    Stream the hourly history of a grid point as (time, record) pairs,
+    where record maps weather codes to measurements
 
-def get_weather_data(grid_id):
-    # Connect to Cassandra database and obtain weather data
-    session = cluster.connect()
-    # session = cassandra.connect()
-    print(session)
-    session.set_keyspace("weather")
+    The per-parameter streams are merged lazily, so memory use does not
+    grow with the length of the history. codes defaults to all weather
+    codes and start/end to the whole history.
+    '''
+    default_start, default_end = history_range()
+    start = start or default_start
+    end = end or default_end
 
-    data = dict()
-    get_weather_records(session, data, grid_id, pressure_code)
-    print(next(iter((data.items()))))
-    get_weather_records(session, data, grid_id, wind_code)
-    print(next(iter((data.items()))))
-    get_weather_records(session, data, grid_id, temp_code)
-    print(next(iter((data.items()))))
-    get_weather_records(session, data, grid_id, humidity_code)
-    print(next(iter((data.items()))))
+    # Obtain weather data from Cassandra, all parameters concurrently with
+    # a bounded number of year buckets in flight
+    session = get_cassandra_session()
+    budget = QueryBudget(app.config["CASSANDRA_MAX_IN_FLIGHT"])
+    streams = [iter_weather_records(session, grid_id, parameter, start, end, budget)
+               for parameter in (codes or weather_codes)]
 
-    return OrderedDict(sorted(data.items(), key=lambda t: t[0]))
+    merged = heapq.merge(*streams, key=lambda t: t[0])
+    for time, records in groupby(merged, key=lambda t: t[0]):
+        yield time, {parameter: measurement for _, parameter, measurement in records}
 
 
-def get_measurements(record):
+def get_measurements(record, codes=None):
     '''
     Given record containing weather data, return streamlined record
     '''
-    pressure = record.get(pressure_code, None)
-    wind = record.get(wind_code, None)
-    temp = record.get(temp_code, None)
-    humidity = record.get(humidity_code, None)
+    values = [record.get(code, None) for code in (codes or weather_codes)]
+    return ['{:.2f}'.format(value) if value is not None else ''
+            for value in values]
+
 
-    return ['{:.2f}'.format(pressure) if pressure is not None else '',
-            '{:.2f}'.format(wind) if wind is not None else '',
-            '{:.2f}'.format(temp) if temp is not None else '',
-            '{:.2f}'.format(humidity) if humidity is not None else '']
-            
+def make_csv(grid_id, codes=None, start=None, end=None, download_format='csv'):
+    '''
+    This function makes csv file with the weather history for a given grid point,
+    restricted to the weather codes and the [start, end) range if given
 
-def make_csv(grid_id):
+    download_format picks another of download_formats.FORMATS: gzipped CSV,
+    Parquet or an Arrow IPC stream. Chunks are encoded as Cassandra pages
+    arrive.
     '''
-    This function makes csv file with the full weather history for a given grid point
+    codes = codes or weather_codes
+    # Time-ordered records streamed from Cassandra
+    data = get_weather_data(grid_id, codes, start, end)
+    encoder = download_formats.make_encoder(download_format, codes, weather_headers,
+                                            weather_columns, get_measurements)
+    return download_formats.encode_stream(data, encoder)
+
+
+def parse_download_options(form):
     '''
-    # OrderedDict assembled from Cassandra
-    data = get_weather_data(grid_id)
+    Read the optional start, end and parameters fields of a download form
 
-    yield ",".join(["Timestamp", "Pressure [mbar]", "Wind [mph]", "Temp [F]", "Humidity [%]"]) + '\n'
-    for timestep, record in data.items():
-        yield ","\
-            .join([item for sublist in [[timestep], get_measurements(record)]
-                  for item in sublist]) + '\n'
+    start and end are dates (YYYY-MM-DD), end inclusive; parameters are
+    names from weather_names or codes, repeated or comma-separated
+
+    Returns
+    -------
+    tuple
+            (codes, start, end), None where not given
+    '''
+    start = form.get('start') or None
+    end = form.get('end') or None
+    try:
+        if start:
+            start = datetime.strptime(start, '%Y-%m-%d')
+        if end:
+            end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        abort(400, 'Dates must be formatted as YYYY-MM-DD')
+    if start and end and start >= end:
+        abort(400, 'start must be before end')
+
+    codes = []
+    for value in form.getlist('parameters'):
+        for name in value.split(','):
+            name = name.strip().lower()
+            if not name:
+                continue
+            code = weather_names.get(name)
+            if code is None and name.isdigit() and int(name) in weather_headers:
+                code = int(name)
+            if code is None:
+                abort(400, 'Unknown parameter {}'.format(name))
+            if code not in codes:
+                codes.append(code)
+    return codes or None, start, end
 
 
 def get_coordinates_from_address(address_request):
     '''
-    This function converts address to coordinates using Google Maps API call
+    This function converts address to coordinates using Google Maps API call,
+    cached by normalized address
     '''
-    geocode_result = gmaps.geocode(address_request)
+    geocode_result = geocoder.geocode(address_request)
 
     # Some defaults
     error_message = 'Please enter a valid U.S. address'
@@ -144,6 +320,374 @@ def get_coordinates_from_address(address_request):
     return latitude, longitude, ''
 
 
+def nearest_covered_grid(latitude, longitude):
+    '''
+    SQL selecting the grid point nearest to a location that has monthly data
+
+    grid_coverage lists the (grid_id, parameter) pairs with data, so the
+    nearest covered grid point is picked inside the query. Candidates come
+    from grid_index on the lattice, and from a PostGIS KNN scan otherwise.
+
+    Returns
+    -------
+    tuple
+            (SELECT returning one grid_id, its bind parameters, a key
+            identifying the location's nearest grid point for caching)
+    '''
+    params = {'codes': weather_codes}
+    candidates = None
+    if grid_index is not None and grid_index.contains(latitude, longitude):
+        candidates = grid_index.ring(latitude, longitude, grid_search_radius)
+
+    if candidates:
+        params['candidates'] = candidates
+        nearest = """
+            SELECT c.grid_id
+            FROM unnest(CAST(:candidates AS int[])) WITH ORDINALITY AS c(grid_id, rank)
+            WHERE EXISTS (SELECT 1 FROM grid_coverage g
+                          WHERE g.grid_id = c.grid_id AND g.parameter = ANY(:codes))
+            ORDER BY c.rank LIMIT 1
+        """
+        key = candidates[0]
+    else:
+        params['point'] = 'POINT({} {})'.format(float(longitude), float(latitude))
+        nearest = """
+            SELECT grid.grid_id FROM grid
+            WHERE EXISTS (SELECT 1 FROM grid_coverage g
+                          WHERE g.grid_id = grid.grid_id AND g.parameter = ANY(:codes))
+            ORDER BY grid.location <-> CAST(:point AS geography) LIMIT 1
+        """
+        key = (round(float(latitude), 4), round(float(longitude), 4))
+    return nearest, params, key
+
+
+def chart_series_query(latitude, longitude):
+    '''
+    SQL reading the chart_series rows of the grid point nearest to a
+    location that has data, see nearest_covered_grid
+
+    Returns
+    -------
+    tuple
+            (SQL with :name bind parameters, its bind parameters, cache key)
+    '''
+    nearest, params, key = nearest_covered_grid(latitude, longitude)
+    sql = """
+        WITH nearest AS ({nearest})
+        SELECT s.grid_id, s.parameter, s.payload
+        FROM chart_series s JOIN nearest USING (grid_id)
+        WHERE s.parameter = ANY(:codes);
+        """.format(nearest=nearest)
+    return sql, params, key
+
+
+def positional_query(sql, params):
+    '''
+    SQL with :name bind parameters rewritten to $1, $2, ... for asyncpg
+
+    Returns
+    -------
+    tuple
+            (SQL, list of arguments in $n order)
+    '''
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '${}'.format(names.index(match.group(1)) + 1)
+
+    sql = re.sub(r'(?<!:):([A-Za-z_]\w*)', number, sql)
+    return sql, [params[name] for name in names]
+
+
+def nearest_grid_series(latitude, longitude):
+    '''
+    Chart series of the grid point nearest to a location that has data
+
+    Series are read pre-serialized from chart_series, which the batch job
+    materializes after every load, and cached per location's nearest grid
+    point until the next load
+
+    Returns
+    -------
+    tuple
+            (grid_id, dict of weather code to JSON [[epoch ms, value], ...]),
+            (None, {}) if no grid point nearby has data
+    '''
+    sql, params, key = chart_series_query(latitude, longitude)
+    cached = chart_cache.get(key)
+    if cached is not None:
+        return cached
+
+    rows = db.session.execute(text(sql), params).fetchall()
+    if rows:
+        result = rows[0].grid_id, {row.parameter: row.payload for row in rows}
+    else:
+        result = None, {}
+    chart_cache.put(key, result)
+    return result
+
+
+def load_generation():
+    '''
+    Generation of the monthly data, bumped by the batch job after each load
+    '''
+    return db.session.execute(
+        text("SELECT generation FROM load_generation;")).scalar()
+
+
+# Rendered chart series per grid point, invalidated when the batch job
+# bumps load_generation after loading measurements_monthly
+# (optionally shared between workers through Redis)
+chart_cache_backend = None
+if app.config["CHART_CACHE_REDIS_URL"]:
+    import redis
+    chart_cache_backend = redis.Redis.from_url(app.config["CHART_CACHE_REDIS_URL"])
+chart_cache = ChartCache(maxsize=app.config["CHART_CACHE_SIZE"],
+                         ttl=app.config["CHART_CACHE_TTL"],
+                         generation_fn=load_generation,
+                         generation_interval=app.config["CHART_CACHE_GENERATION_INTERVAL"],
+                         backend=chart_cache_backend)
+
+
+# Monthly rasters written by the batch job (spark/monthly_rasters.py)
+raster_store = rasters.RasterStore(app.config["RASTER_PATH"],
+                                   app.config["RASTER_CACHE_SIZE"],
+                                   app.config["RASTER_CACHE_DIR"],
+                                   app.config["RASTER_REFRESH_INTERVAL"])
+
+
+def chart_json(grid_id, series):
+    '''
+    Body of /api/chart: the grid point and its series per weather code,
+    with the pre-serialized payloads spliced in as is
+    '''
+    return '{{"grid_id": {}, "series": {{{}}}}}'.format(
+        grid_id, ', '.join('"{}": {}'.format(code, series[code])
+                           for code in weather_codes if code in series))
+
+
+@app.route('/api/chart', methods=['GET'])
+def chart_data():
+    '''
+    Dashboard chart series for a location as JSON, see nearest_grid_series
+
+    GET /api/chart?lat=..&lon=..
+    '''
+    try:
+        latitude = float(request.args['lat'])
+        longitude = float(request.args['lon'])
+    except (KeyError, ValueError):
+        abort(400, 'lat and lon must be numbers')
+    grid_id, series = nearest_grid_series(latitude, longitude)
+    if grid_id is None:
+        abort(404, 'No weather history near this location')
+    return Response(chart_json(grid_id, series), mimetype='application/json')
+
+
+def series_request_options():
+    '''
+    Options of a bulk series request, from a JSON body or from the query
+    string / form, as a MultiDict of strings
+
+    In a JSON body lists become comma-separated values and points, a list
+    of [lat, lon] pairs, becomes 'lat,lon;lat,lon;...' as in the query string
+    '''
+    body = request.get_json(silent=True)
+    if body is None:
+        return request.values
+    if not isinstance(body, dict):
+        abort(400, 'The request body must be a JSON object')
+    options = MultiDict()
+    try:
+        for name, value in body.items():
+            if name == 'points':
+                value = ';'.join(','.join(str(c) for c in point) for point in value)
+            elif isinstance(value, (list, tuple)):
+                value = ','.join(str(v) for v in value)
+            options.add(name, str(value))
+    except TypeError:
+        abort(400, 'points must be a list of [lat, lon] pairs')
+    return options
+
+
+def parse_numbers(value, name, number=float):
+    '''
+    Comma-separated numbers of a bulk series option
+    '''
+    try:
+        return [number(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        abort(400, '{} must be comma-separated numbers'.format(name))
+
+
+def unique(ids):
+    '''
+    ids without repeats, in order of first appearance
+    '''
+    return list(dict.fromkeys(ids))
+
+
+def nearest_grid_ids(points):
+    '''
+    Nearest grid point of each (lat, lon), from grid_index on the lattice
+    and from one PostGIS KNN query for the remaining points
+    '''
+    ids = [grid_index.nearest(latitude, longitude)
+           if grid_index is not None and grid_index.contains(latitude, longitude)
+           else None for latitude, longitude in points]
+    missing = [i for i, grid_id in enumerate(ids) if grid_id is None]
+    if missing:
+        rows = db.session.execute(text(
+            """
+            SELECT p.i, g.grid_id
+            FROM unnest(CAST(:lats AS float8[]), CAST(:lons AS float8[]))
+                WITH ORDINALITY AS p(lat, lon, i)
+            CROSS JOIN LATERAL (
+                SELECT grid.grid_id FROM grid
+                ORDER BY grid.location <->
+                    CAST(ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326) AS geography)
+                LIMIT 1) g;
+            """), {'lats': [points[i][0] for i in missing],
+                     'lons': [points[i][1] for i in missing]}).fetchall()
+        for row in rows:
+            ids[missing[row.i - 1]] = row.grid_id
+    return ids
+
+
+def bbox_grid_ids(south, west, north, east):
+    '''
+    Grid points inside a bounding box
+    '''
+    if grid_index is not None:
+        return grid_index.bbox(south, west, north, east)
+    rows = db.session.execute(text(
+        """
+        SELECT grid_id FROM grid
+        WHERE latitude BETWEEN :south AND :north
+          AND longitude BETWEEN :west AND :east
+        ORDER BY grid_id;
+        """), {'south': south, 'west': west, 'north': north, 'east': east})
+    return [row.grid_id for row in rows]
+
+
+def series_grid_ids(options):
+    '''
+    Grid points of a bulk series request, given as grid_ids, as points
+    (the nearest grid point of each 'lat,lon', separated by ';') or as a
+    bbox 'south,west,north,east'
+
+    Returns
+    -------
+    tuple
+            (grid ids without repeats, grid id of each point or None)
+    '''
+    if options.get('grid_ids'):
+        return unique(parse_numbers(options['grid_ids'], 'grid_ids', int)), None
+    if options.get('points'):
+        points = [parse_numbers(point, 'points')
+                  for point in options['points'].split(';') if point.strip()]
+        if any(len(point) != 2 for point in points):
+            abort(400, 'points must be lat,lon pairs')
+        point_ids = nearest_grid_ids(points)
+        return unique(i for i in point_ids if i is not None), point_ids
+    if options.get('bbox'):
+        bbox = parse_numbers(options['bbox'], 'bbox')
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            abort(400, 'bbox must be south,west,north,east')
+        return bbox_grid_ids(*bbox), None
+    abort(400, 'One of grid_ids, points or bbox is required')
+
+
+def epoch_ms(time):
+    return int((time - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def series_columns():
+    return {'grid_id': [], 'parameter': [], 'time': [], 'value': []}
+
+
+def monthly_series(grid_ids, codes, start, end, batch_rows):
+    '''
+    Monthly values of many grid points as columns, in a single query
+    read through a server-side cursor
+
+    Yields
+    ------
+    dict
+            Lists grid_id, parameter, time (epoch ms) and value of up to
+            batch_rows rows, ordered by grid_id, parameter and time
+    '''
+    result = db.session.execute(text(
+        """
+        SELECT grid_id, parameter,
+               CAST(extract(epoch FROM time) * 1000 AS bigint) AS time, c
+        FROM measurements_monthly
+        WHERE grid_id = ANY(:grid_ids) AND parameter = ANY(:codes)
+          AND time >= :start AND time < :end
+        ORDER BY grid_id, parameter, time;
+        """), {'grid_ids': grid_ids, 'codes': codes, 'start': start, 'end': end},
+        # Server-side cursor, so only batch_rows rows are held at a time
+        execution_options={'stream_results': True})
+    while True:
+        rows = result.fetchmany(batch_rows)
+        if not rows:
+            break
+        yield dict(zip(('grid_id', 'parameter', 'time', 'value'),
+                       [list(column) for column in zip(*rows)]))
+
+
+def hourly_series(grid_ids, codes, start, end, concurrency, batch_rows):
+    '''
+    Hourly values of several grid points as columns, with at most
+    concurrency Cassandra queries (one per grid point, parameter and year)
+    in flight
+
+    Yields
+    ------
+    dict
+            As monthly_series; a batch is handed on as soon as it holds
+            batch_rows rows, so a response never holds the whole series
+    '''
+    session = get_cassandra_session()
+    in_flight = deque()
+    columns = series_columns()
+
+    def queries():
+        for grid_id in grid_ids:
+            for parameter in codes:
+                for year in history_years(start, end):
+                    yield grid_id, parameter, year
+
+    pending = queries()
+    while True:
+        for grid_id, parameter, year in pending:
+            in_flight.append((grid_id, parameter,
+                              query_weather_year(session, grid_id, parameter,
+                                                 year, start, end)))
+            if len(in_flight) >= concurrency:
+                break
+        if not in_flight:
+            break
+
+        grid_id, parameter, future = in_flight.popleft()
+        for record in future.result():
+            columns['grid_id'].append(grid_id)
+            columns['parameter'].append(parameter)
+            columns['time'].append(epoch_ms(record.time))
+            columns['value'].append(record.measurement)
+            if len(columns['time']) >= batch_rows:
+                yield columns
+                columns = series_columns()
+    yield columns
+
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(chart_cache.stats())
+
+
 @app.route('/download', methods=['GET', 'POST'])
 def download():
 
@@ -152,16 +696,158 @@ def download():
 
     elif request.method == 'POST':
         grid_id = request.form['grid_id']
+        codes, start, end = parse_download_options(request.form)
+        download_format = download_formats.negotiate_format(
+            request.form.get('format'), request.accept_mimetypes)
+        if download_format is None:
+            abort(400, 'format must be one of {}'.format(
+                ', '.join(sorted(download_formats.FORMATS))))
+        mimetype, extension = download_formats.FORMATS[download_format]
         return Response(
-            stream_with_context(make_csv(grid_id)),
-            mimetype='text/csv',
+            stream_with_context(make_csv(grid_id, codes, start, end,
+                                         download_format)),
+            mimetype=mimetype,
             headers={
                 "Content-Disposition":
-                "attachment; filename=data_grid_{}.csv".format(grid_id)
+                "attachment; filename=data_grid_{}.{}".format(grid_id, extension),
+                "Vary": "Accept"
             }
         )
 
 
+@app.route('/api/series', methods=['GET', 'POST'])
+def series():
+    '''
+    Time series of many grid points in one response
+
+    Options, as query string, form or JSON body: one of grid_ids, points or
+    bbox (see series_grid_ids), plus start, end and parameters as in
+    /download, resolution (monthly or hourly) and format (json or arrow,
+    else from the Accept header). Hourly series need an explicit start and
+    end and are capped at BULK_MAX_HOURLY_VALUES grid points x parameters
+    x hours. Values are streamed in batches of columns grid_id, parameter,
+    time (epoch ms) and value: Arrow record batches, or a JSON "batches"
+    list next to the request metadata.
+    '''
+    options = series_request_options()
+    codes, start, end = parse_download_options(options)
+    codes = codes or weather_codes
+
+    resolution = options.get('resolution', 'monthly')
+    if resolution not in ('monthly', 'hourly'):
+        abort(400, 'resolution must be monthly or hourly')
+    if resolution == 'hourly' and (start is None or end is None):
+        abort(400, 'start and end are required for hourly series')
+    default_start, default_end = history_range()
+    start = start or default_start
+    end = end or default_end
+
+    series_format = options.get('format') or request.accept_mimetypes.best_match(
+        ['application/json', 'application/vnd.apache.arrow.stream'],
+        default='application/json')
+    series_format = {'application/json': 'json',
+                     'application/vnd.apache.arrow.stream': 'arrow'}.get(series_format, series_format)
+    if series_format not in ('json', 'arrow'):
+        abort(400, 'format must be json or arrow')
+
+    grid_ids, point_ids = series_grid_ids(options)
+    max_grids = app.config['BULK_MAX_GRIDS'] if resolution == 'monthly'\
+        else app.config['BULK_MAX_HOURLY_GRIDS']
+    if len(grid_ids) > max_grids:
+        abort(400, '{} grid points requested, at most {} for {} series'.format(
+            len(grid_ids), max_grids, resolution))
+
+    batch_rows = app.config['BULK_BATCH_ROWS']
+    if resolution == 'monthly':
+        batches = monthly_series(grid_ids, codes, start, end, batch_rows)
+    else:
+        hours = max((end - start).total_seconds() / 3600., 0)
+        values = int(len(grid_ids) * len(codes) * hours)
+        if values > app.config['BULK_MAX_HOURLY_VALUES']:
+            abort(400, '{} hourly values requested (grid points x parameters x hours), '
+                       'at most {}'.format(values, app.config['BULK_MAX_HOURLY_VALUES']))
+        batches = hourly_series(grid_ids, codes, start, end,
+                                app.config['BULK_HOURLY_CONCURRENCY'], batch_rows)
+
+    info = {'resolution': resolution, 'parameters': codes,
+            'start': epoch_ms(start), 'end': epoch_ms(end), 'grid_ids': grid_ids}
+    if point_ids is not None:
+        info['points'] = point_ids
+    if series_format == 'arrow':
+        body = download_formats.series_arrow_stream(batches, info)
+        mimetype = 'application/vnd.apache.arrow.stream'
+    else:
+        body = download_formats.series_json_stream(batches, info)
+        mimetype = 'application/json'
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Vary': 'Accept'})
+
+
+def raster_options(parameter, month):
+    '''
+    Weather code and first day of the month of a raster request; parameter
+    is a name from weather_names or a code, month is YYYY-MM
+    '''
+    code = weather_names.get(parameter.lower())
+    if code is None and parameter.isdigit() and int(parameter) in weather_headers:
+        code = int(parameter)
+    if code is None:
+        abort(404, 'Unknown parameter {}'.format(parameter))
+    try:
+        month = datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        abort(404, 'Months are formatted as YYYY-MM')
+    return code, month
+
+
+@app.route('/rasters/<parameter>/<month>.npy', methods=['GET'])
+def monthly_raster(parameter, month):
+    '''
+    Whole-lattice raster of a parameter and month as a .npy file, row 0
+    south and NaN where there is no value
+    '''
+    code, month = raster_options(parameter, month)
+    fname = raster_store.fetch(code, month)
+    if fname is None:
+        abort(404, 'No raster for {} {:%Y-%m}'.format(parameter, month))
+    return send_file(fname, mimetype='application/octet-stream',
+                     conditional=True, etag=True,
+                     max_age=app.config["RASTER_MAX_AGE"])
+
+
+@app.route('/tiles/<parameter>/<month>/<int:z>/<int:x>/<int:y>.npy', methods=['GET'])
+def raster_tile(parameter, month, z, x, y):
+    '''
+    Web Mercator tile z/x/y of a monthly raster as a .npy file of
+    RASTER_TILE_SIZE x RASTER_TILE_SIZE values, row 0 north; 204 for
+    tiles off the lattice
+    '''
+    code, month = raster_options(parameter, month)
+    if z > app.config["RASTER_MAX_ZOOM"] or x >= 2 ** z or y >= 2 ** z:
+        abort(404, 'No tile {}/{}/{}'.format(z, x, y))
+    if grid_index is None:
+        abort(503, 'Grid index not loaded')
+    raster, version = raster_store.load(code, month)
+    if raster is None:
+        abort(404, 'No raster for {} {:%Y-%m}'.format(parameter, month))
+
+    etag = '{}-{}-{}-{}-{}'.format(version, app.config["RASTER_TILE_SIZE"], z, x, y)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        pixels = rasters.tile(raster, grid_index, z, x, y,
+                              app.config["RASTER_TILE_SIZE"])
+        if pixels is None:
+            response = Response(status=204)
+        else:
+            response = Response(rasters.npy_bytes(pixels),
+                                mimetype='application/octet-stream')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["RASTER_MAX_AGE"]
+    return response
+
+
 @app.route('/', methods=['GET', 'POST'])
 def dashboard():
 
@@ -169,91 +855,33 @@ def dashboard():
         '''
         This function prepares Http request object,
         based on user's location input
-        '''
-        sql = text(
-            """
-            SELECT ST_Distance(location, 'POINT({longitude} {latitude})'::geography) as d, grid_id, longitude, latitude
-            FROM grid ORDER BY location <-> 'POINT({longitude} {latitude})'::geography limit 10000;
-            """.format(**locals())
-        )
-        print(sql)
-        nearest_grid_points = db.engine.execute(sql).fetchall()
-        print(nearest_grid_points[0:10])
-
-        for i in range(0, len(nearest_grid_points)):
-            grid_id = nearest_grid_points[i][1]
-            history_measurements = models.measurements_monthly\
-                .query.filter_by(grid_id=grid_id)\
-                .order_by(models.measurements_monthly.time.asc()).all()
-
-            if not history_measurements:
-                # The grid point we found does not contain any historical
-                # data (for example, it is far from any air quality station)
-                continue
 
-            else:                
-                pressure = [x for x in history_measurements if x.parameter == pressure_code]
-                pressure_data = [[1000*int(x.time.strftime('%s')), round(x.c,2)] for x in pressure]
-
-                wind = [x for x in history_measurements if x.parameter == wind_code]
-                wind_data = [[1000*int(x.time.strftime('%s')), round(x.c,2)] for x in wind]
-                
-                temp = [x for x in history_measurements if x.parameter == temp_code]
-                temp_data = [[1000*int(x.time.strftime('%s')), round(x.c,2)] for x in temp]
-
-                humidity = [x for x in history_measurements if x.parameter == humidity_code]
-                humidity_data = [[1000*int(x.time.strftime('%s')), round(x.c,2)] for x in humidity]
-                print("grid point:")
-                print(grid_id)
-                
-                print("pressure!")
-                print(pressure_data)
-                print(len(pressure_data))
-                print("wind!")
-                print(wind_data)
-                print(len(wind_data))
-                print("temperature!")
-                print(temp_data)
-                print(len(temp_data))
-                print("humidity!")
-                print(humidity_data)
-                print(len(humidity_data))
-
-                if len(pressure_data) == 0 and len(wind_data) == 0 and len(temp_data) == 0 and len(humidity_data) == 0:
-                    rendered_webpage = request_from_location(
-                            chi['lat'],
-                            chi['lon'],
-                            'Location you entered is too far from air quality monitors'
-                        )
-                    return rendered_webpage
-
-                # Set up charts
-                chart_type = 'line'
-                chart_height = 350
-                chart_pressure = {"renderTo": 'chart_pressure', "type": chart_type, "height": chart_height}
-                chart_wind = {"renderTo": 'chart_wind', "type": chart_type, "height": chart_height}
-                chart_temp = {"renderTo": 'chart_wind', "type": chart_type, "height": chart_height}
-                chart_humidity = {"renderTo": 'chart_humidity', "type": chart_type, "height": chart_height}
-                series_pressure = [{'pointInterval': 30 * 24 * 3600 * 1000, "name": 'Pressure', "data": pressure_data}]
-                series_wind = [{'pointInterval': 30 * 24 * 3600 * 1000, "name": 'Wind', "data": wind_data}]
-                series_temp = [{'pointInterval': 30 * 24 * 3600 * 1000, "name": 'Temp', "data": temp_data}]
-                series_humidity = [{'pointInterval': 30 * 24 * 3600 * 1000, "name": 'Humidity', "data": humidity_data}]
-                print("series_pressure")
-                print(series_pressure)
-                break
+        The page fetches its chart series from /api/chart, so rendering
+        it does not wait on the database
+        '''
+        # Set up charts
+        chart_type = 'line'
+        chart_height = 350
+        chart_pressure = {"renderTo": 'chart_pressure', "type": chart_type, "height": chart_height}
+        chart_wind = {"renderTo": 'chart_wind', "type": chart_type, "height": chart_height}
+        chart_temp = {"renderTo": 'chart_wind', "type": chart_type, "height": chart_height}
+        chart_humidity = {"renderTo": 'chart_humidity', "type": chart_type, "height": chart_height}
 
         return render_template(
             'dashboard.html', chart_pressure=chart_pressure, chart_wind=chart_wind, 
             chart_temp=chart_temp, chart_humidity=chart_humidity,
-            series_pressure=series_pressure, series_wind=series_wind,
-            series_temp=series_temp, series_humidity=series_humidity,
-            lat=latitude, lon=longitude, grid_id=grid_id, API_url=API_url,
+            chart_codes=json.dumps(weather_names),
+            lat=latitude, lon=longitude, chi=chi, API_url=API_url,
             error_message=error_message
         )
 
     if request.method == 'GET':
-        # Default coordinates in Chicago downtown
-        rendered_webpage = request_from_location(chi['lat'], chi['lon'])
+        # Default coordinates in Chicago downtown; the page comes back here
+        # with far=1 when /api/chart finds no data near the address
+        error_message = ''
+        if request.args.get('far'):
+            error_message = 'Location you entered is too far from weather stations'
+        rendered_webpage = request_from_location(chi['lat'], chi['lon'], error_message)
         return rendered_webpage
 
     elif request.method == 'POST':
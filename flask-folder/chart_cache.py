@@ -0,0 +1,116 @@
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+
+class ChartCache(object):
+    '''
+    Size-bounded LRU cache of rendered chart series with TTL and
+    load-generation invalidation
+
+    Every entry remembers the load generation it was computed under. The
+    batch job bumps the generation after loading measurements_monthly, and
+    entries from an older generation are treated as misses. The current
+    generation is read through generation_fn at most once every
+    generation_interval seconds.
+
+    An optional shared backend (any object with get(key) and
+    set(key, value, ex=seconds), such as a Redis client or a local stand-in)
+    is consulted on local misses, so several workers share rendered series.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=3600, generation_fn=None,
+                 generation_interval=30, backend=None, prefix='chart:'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation_fn = generation_fn
+        self.generation_interval = generation_interval
+        self.backend = backend
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._entries = OrderedDict()
+        self._generation = None
+        self._generation_checked = 0.
+        self._lock = threading.Lock()
+
+    def generation(self):
+        '''
+        Current load generation, refreshed every generation_interval seconds
+        '''
+        if self.generation_fn is None:
+            return None
+        now = time.time()
+        if now - self._generation_checked >= self.generation_interval:
+            self._generation = self.generation_fn()
+            self._generation_checked = now
+        return self._generation
+
+    def get(self, key):
+        '''
+        Return the cached value for key, or None on a miss
+        '''
+        generation = self.generation()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires, value = entry
+                if entry_generation == generation and expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.backend is not None:
+            raw = self.backend.get(self._backend_key(key, generation))
+            if raw is not None:
+                value = pickle.loads(raw)
+                self._store(key, generation, value)
+                with self._lock:
+                    self.shared_hits += 1
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        '''
+        Cache value for key under the current load generation
+        '''
+        generation = self.generation()
+        self._store(key, generation, value)
+        if self.backend is not None:
+            self.backend.set(self._backend_key(key, generation),
+                             pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                             ex=int(self.ttl))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Hit, miss and size counters
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'shared_hits': self.shared_hits,
+                    'size': len(self._entries), 'maxsize': self.maxsize,
+                    'generation': self._generation}
+
+    def _store(self, key, generation, value):
+        with self._lock:
+            self._entries[key] = (generation, time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _backend_key(self, key, generation):
+        # The generation is part of the shared key, so stale entries are
+        # never read and simply expire
+        return '{}{}:{}'.format(self.prefix, generation, key)
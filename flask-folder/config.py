@@ -35,6 +35,41 @@ class Config(object):
     GOOGLEMAPSJSKEY = GoogleMapsJSKey
     CASSANDRA_USER = CassandraUser
     CASSANDRA_PASSWORD = CassandraPassword
+    # Rows per page of hourly history queries
+    CASSANDRA_FETCH_SIZE = 5000
+    # Hourly year-bucket queries one download keeps in flight (each stream
+    # reads one bucket and prefetches the next)
+    CASSANDRA_MAX_IN_FLIGHT = 8
+    # Lattice index written by spark/generate_uniform_grid.py
+    GRID_INDEX_PATH = os.path.join(basedir, 'grid_index.npz')
+    # Chart series cache: entries, seconds to live, and seconds between
+    # checks of the batch load generation
+    CHART_CACHE_SIZE = 4096
+    CHART_CACHE_TTL = 24 * 3600
+    CHART_CACHE_GENERATION_INTERVAL = 30
+    # e.g. 'redis://localhost:6379/0' to share the cache between workers
+    CHART_CACHE_REDIS_URL = None
+    # SQLite file persisting geocoding results (including addresses not found)
+    GEOCODE_CACHE_PATH = os.path.join(basedir, 'geocode_cache.sqlite')
+    # Bulk series API: most grid points per request (monthly and hourly),
+    # most grid points x parameters x hours of an hourly request, most
+    # Cassandra queries in flight for it and rows per streamed batch
+    BULK_MAX_GRIDS = 5000
+    BULK_MAX_HOURLY_GRIDS = 25
+    BULK_MAX_HOURLY_VALUES = 5000000
+    BULK_HOURLY_CONCURRENCY = 32
+    BULK_BATCH_ROWS = 65536
+    # Monthly rasters written by raw_batch.py --rasters: directory or
+    # s3://bucket/prefix (the same as --rasters), rasters kept open, local
+    # copies of S3 rasters and seconds between their revalidations, seconds
+    # clients may cache them, tile size and largest zoom
+    RASTER_PATH = os.path.join(basedir, 'rasters')
+    RASTER_CACHE_SIZE = 64
+    RASTER_CACHE_DIR = os.path.join(basedir, 'raster_cache')
+    RASTER_REFRESH_INTERVAL = 300
+    RASTER_MAX_AGE = 3600
+    RASTER_TILE_SIZE = 256
+    RASTER_MAX_ZOOM = 10
     # CASSANDRA_NODES = CassandraNode
 
 
@@ -0,0 +1,278 @@
+import json
+import zlib
+from datetime import timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Download formats: name -> (mimetype, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+
+def negotiate_format(requested, accept_mimetypes):
+    '''
+    Pick the download format from an explicit format field, or else from
+    the Accept header; CSV if neither names a known format
+
+    Parameters
+    ----------
+    requested : str or None
+                Value of the format form field
+    accept_mimetypes : werkzeug.datastructures.MIMEAccept
+                Parsed Accept header, e.g. request.accept_mimetypes
+
+    Returns
+    -------
+    str
+                Key of FORMATS, None if requested is not a known format
+    '''
+    if requested:
+        requested = requested.strip().lower()
+        return requested if requested in FORMATS else None
+    by_mimetype = {mimetype: name for name, (mimetype, _) in FORMATS.items()}
+    best = accept_mimetypes.best_match(list(by_mimetype), default='text/csv')
+    return by_mimetype[best]
+
+
+class CsvEncoder(object):
+    '''
+    CSV text of (time, record) rows, where record maps weather codes to
+    measurements; format_values maps (record, codes) to the row's cells
+    '''
+    rows = 2000
+
+    def __init__(self, codes, headers, format_values):
+        self.codes = codes
+        self.format_values = format_values
+        self._header = ",".join(["Timestamp"] + [headers[code] for code in codes])
+
+    def encode(self, rows):
+        lines = [self._header] if self._header else []
+        self._header = None
+        for time, record in rows:
+            lines.append(",".join([time.strftime('%Y-%m-%d %H:%M')]
+                                  + self.format_values(record, self.codes)))
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+    def finish(self):
+        return self.encode([]) if self._header else b''
+
+
+class GzipEncoder(object):
+    '''
+    Gzip stream of another encoder's output
+    '''
+
+    def __init__(self, encoder, level=6):
+        self.encoder = encoder
+        self.rows = encoder.rows
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def encode(self, rows):
+        return self._compressor.compress(self.encoder.encode(rows))
+
+    def finish(self):
+        return self._compressor.compress(self.encoder.finish())\
+            + self._compressor.flush()
+
+
+class ChunkSink(object):
+    '''
+    Write-only file object that keeps what is written until drained, so
+    a pyarrow writer's output can be streamed out as it is produced
+    '''
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ColumnarEncoder(object):
+    '''
+    Base of the Arrow based encoders: every encode() call becomes one
+    record batch of a UTC timestamp column and one float32 column per
+    weather code, with nulls for missing measurements
+    '''
+    rows = 65536
+
+    def __init__(self, codes, names, compression='zstd'):
+        self.codes = codes
+        self.schema = pa.schema([('time', pa.timestamp('ms', tz='UTC'))]
+                                + [(names[code], pa.float32()) for code in codes])
+        self.sink = ChunkSink()
+        self.writer = self.open(compression)
+
+    def batch(self, rows):
+        times = [time.replace(tzinfo=timezone.utc) for time, _ in rows]
+        columns = [pa.array([record.get(code) for _, record in rows], pa.float32())
+                   for code in self.codes]
+        return pa.RecordBatch.from_arrays(
+            [pa.array(times, self.schema.field(0).type)] + columns,
+            schema=self.schema)
+
+    def encode(self, rows):
+        if rows:
+            self.write(self.batch(rows))
+        return self.sink.drain()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.drain()
+
+
+class ParquetEncoder(ColumnarEncoder):
+    '''
+    Parquet file, one row group per encode() call
+    '''
+
+    def open(self, compression):
+        return pq.ParquetWriter(self.sink, self.schema, compression=compression)
+
+    def write(self, batch):
+        self.writer.write_table(pa.Table.from_batches([batch]))
+
+
+class ArrowEncoder(ColumnarEncoder):
+    '''
+    Arrow IPC stream, one record batch per encode() call
+    '''
+
+    def open(self, compression):
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        return pa.ipc.new_stream(self.sink, self.schema, options=options)
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+
+
+def make_encoder(download_format, codes, headers, names, format_values):
+    '''
+    Encoder of a FORMATS download
+
+    Parameters
+    ----------
+    download_format : str
+                Key of FORMATS
+    codes : list
+                Weather codes, in column order
+    headers : dict
+                CSV column header of each weather code
+    names : dict
+                Parquet/Arrow column name of each weather code
+    format_values : callable
+                Maps (record, codes) to the formatted CSV cells of a row
+    '''
+    if download_format == 'csv':
+        return CsvEncoder(codes, headers, format_values)
+    if download_format == 'csv.gz':
+        return GzipEncoder(CsvEncoder(codes, headers, format_values))
+    if download_format == 'parquet':
+        return ParquetEncoder(codes, names)
+    if download_format == 'arrow':
+        return ArrowEncoder(codes, names)
+    raise ValueError('Unknown download format {}'.format(download_format))
+
+
+def encode_stream(data, encoder):
+    '''
+    Encode time-ordered (time, record) pairs in chunks of encoder.rows rows
+
+    Yields
+    ------
+    bytes
+                Encoded chunks, empty ones skipped
+    '''
+    rows = []
+    for row in data:
+        rows.append(row)
+        if len(rows) >= encoder.rows:
+            chunk = encoder.encode(rows)
+            rows = []
+            if chunk:
+                yield chunk
+    chunk = encoder.encode(rows) + encoder.finish()
+    if chunk:
+        yield chunk
+
+
+# Columns of bulk series batches
+SERIES_SCHEMA = pa.schema([('grid_id', pa.int32()), ('parameter', pa.int32()),
+                           ('time', pa.timestamp('ms', tz='UTC')),
+                           ('value', pa.float32())])
+
+
+def series_arrow_stream(batches, metadata=None):
+    '''
+    Arrow IPC stream of bulk series batches, each a dict of lists grid_id,
+    parameter, time (epoch ms) and value, with metadata stored as JSON in
+    the schema
+
+    Yields
+    ------
+    bytes
+                The stream, one record batch per non-empty batch
+    '''
+    schema = SERIES_SCHEMA
+    if metadata:
+        schema = schema.with_metadata({'series': json.dumps(metadata)})
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for columns in batches:
+        if not columns['time']:
+            continue
+        writer.write_batch(pa.RecordBatch.from_arrays([
+            pa.array(columns['grid_id'], pa.int32()),
+            pa.array(columns['parameter'], pa.int32()),
+            pa.array(columns['time'], pa.int64()).cast(schema.field('time').type),
+            pa.array(columns['value'], pa.float32()),
+        ], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def series_json_stream(batches, metadata):
+    '''
+    JSON object of metadata with the bulk series batches as a list of
+    column objects under "batches", written batch by batch
+
+    Yields
+    ------
+    bytes
+    '''
+    head = json.dumps(metadata, separators=(',', ':'))
+    yield (head[:-1] + (',' if metadata else '') + '"batches":[').encode('utf-8')
+    separator = ''
+    for columns in batches:
+        if columns['time']:
+            yield (separator + json.dumps(columns, separators=(',', ':'))).encode('utf-8')
+            separator = ','
+    yield b']}'
@@ -0,0 +1,108 @@
+import re
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def normalize_address(address):
+    '''
+    Normalize an address for cache lookups: lower case, single spaces,
+    no surrounding punctuation or spaces around commas
+    '''
+    address = re.sub(r'\s+', ' ', address.strip().lower())
+    address = re.sub(r'\s*,\s*', ', ', address)
+    return address.strip(' ,.')
+
+
+class GeocodeCache(object):
+    '''
+    Cache in front of a geocoder, keyed by normalized address
+
+    Results live in an in-memory LRU backed by a SQLite file, so they
+    survive restarts and are shared by the workers of one host. Empty
+    (negative) results are cached as well, for negative_ttl seconds.
+
+    The geocoder is any callable taking an address and returning a list of
+    results in the Google Geocoding format, e.g. googlemaps.Client.geocode
+    or a local stand-in in tests. Only the first result is kept.
+    '''
+
+    def __init__(self, geocoder, path=':memory:', maxsize=4096,
+                 negative_ttl=24 * 3600):
+        self.geocoder = geocoder
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS geocode (
+                address TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created REAL NOT NULL)
+            """
+        )
+        self._db.commit()
+
+    def geocode(self, address):
+        '''
+        Return the geocoding results for an address, from the cache if possible
+
+        Returns
+        -------
+        list
+                At most one result; empty if the address was not found
+        '''
+        key = normalize_address(address)
+        result = self._get(key)
+        if result is not None:
+            return result
+
+        result = list(self.geocoder(address)[:1])
+        self._put(key, result)
+        return result
+
+    def _valid(self, result, created):
+        return bool(result) or time.time() - created < self.negative_ttl
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._valid(*entry):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            row = self._db.execute(
+                "SELECT result, created FROM geocode WHERE address = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                result, created = json.loads(row[0]), row[1]
+                if self._valid(result, created):
+                    self._remember(key, result, created)
+                    self.hits += 1
+                    return result
+
+            self.misses += 1
+            return None
+
+    def _put(self, key, result):
+        created = time.time()
+        with self._lock:
+            self._remember(key, result, created)
+            self._db.execute(
+                "INSERT OR REPLACE INTO geocode (address, result, created) VALUES (?, ?, ?)",
+                (key, json.dumps(result), created)
+            )
+            self._db.commit()
+
+    def _remember(self, key, result, created):
+        self._entries[key] = (result, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -0,0 +1,139 @@
+import numpy as np
+
+
+class GridIndex(object):
+    '''
+    Raster of grid ids over the uniform lat/lon lattice of
+    spark/generate_uniform_grid.py
+
+    raster[ilat, ilon] is the id of the grid point at
+    (S + d_lat*ilat, W + d_lon*ilon), or 0 where the lattice point is
+    outside the U.S. The nearest grid points of a coordinate are found
+    arithmetically, without a database query.
+    '''
+
+    def __init__(self, raster, N, S, W, E):
+        self.raster = raster
+        self.N, self.S, self.W, self.E = N, S, W, E
+        self.N_lat, self.N_lon = raster.shape
+        self.d_lat = (N - S) / float(self.N_lat)
+        self.d_lon = (E - W) / float(self.N_lon)
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        Load the index written by generate_uniform_grid.py
+        '''
+        with np.load(fname) as f:
+            return cls(f['raster'], float(f['N']), float(f['S']),
+                       float(f['W']), float(f['E']))
+
+    def contains(self, latitude, longitude):
+        '''
+        True if the coordinate lies within the lattice
+        '''
+        return self.S <= latitude <= self.N and self.W <= longitude <= self.E
+
+    def cell(self, latitude, longitude):
+        '''
+        Lattice indices (ilat, ilon) of the lattice point nearest in degrees
+        '''
+        ilat = int(round((latitude - self.S) / self.d_lat))
+        ilon = int(round((longitude - self.W) / self.d_lon))
+        return ilat, ilon
+
+    def lon_radius(self, latitude, radius):
+        '''
+        Half-width in lattice columns of a window that holds every lattice
+        point within radius latitude steps of arc of a coordinate
+
+        A degree of longitude shrinks by cos(latitude), so the window is
+        widened by 1/cos of its most poleward row.
+        '''
+        poleward = min(abs(latitude) + (radius + 0.5) * self.d_lat, 89.)
+        return int(np.ceil(radius * self.d_lat /
+                           (self.d_lon * np.cos(np.radians(poleward)))))
+
+    def window(self, latitude, longitude, radius):
+        '''
+        Grid points around a coordinate with their great-circle distances
+
+        Returns
+        -------
+        tuple
+                    (ids, distances in radians), both sorted by distance
+        '''
+        ilat, ilon = self.cell(latitude, longitude)
+        lon_radius = self.lon_radius(latitude, radius)
+        lat0, lat1 = max(ilat - radius, 0), min(ilat + radius + 1, self.N_lat)
+        lon0, lon1 = max(ilon - lon_radius, 0), min(ilon + lon_radius + 1, self.N_lon)
+        if lat0 >= lat1 or lon0 >= lon1:
+            return np.empty(0, dtype=self.raster.dtype), np.empty(0)
+
+        window = self.raster[lat0:lat1, lon0:lon1]
+        rows, cols = np.nonzero(window)
+        lat = np.radians(self.S + self.d_lat * (rows + lat0))
+        lon = np.radians(self.W + self.d_lon * (cols + lon0))
+        lat_p, lon_p = np.radians(latitude), np.radians(longitude)
+        a = np.sin((lat - lat_p) / 2.0) ** 2 + \
+            np.cos(lat_p) * np.cos(lat) * np.sin((lon - lon_p) / 2.0) ** 2
+        order = np.argsort(a, kind='stable')
+        distances = 2.0 * np.arcsin(np.sqrt(np.clip(a[order], 0.0, 1.0)))
+        return window[rows[order], cols[order]], distances
+
+    def ring(self, latitude, longitude, radius):
+        '''
+        Grid points within radius lattice steps of a coordinate
+
+        Parameters
+        ----------
+        latitude, longitude : float
+                    Coordinates in degrees
+        radius : int
+                    Half-height of the window of lattice points to consider,
+                    see lon_radius for its width
+
+        Returns
+        -------
+        list
+                    Grid ids sorted by great-circle distance to the coordinate
+        '''
+        return self.window(latitude, longitude, radius)[0].tolist()
+
+    def nearest(self, latitude, longitude, max_radius=3):
+        '''
+        Id of the grid point nearest to a coordinate, None if there is none
+        within max_radius latitude steps
+
+        The window is grown until its nearest point is no farther than the
+        window's guaranteed reach, so a closer point cannot lie outside it.
+        '''
+        for radius in range(1, max_radius + 1):
+            ids, distances = self.window(latitude, longitude, radius)
+            if len(ids) and distances[0] <= np.radians(radius * self.d_lat):
+                return int(ids[0])
+        return None
+
+    def bbox(self, south, west, north, east):
+        '''
+        Ids of the grid points inside a bounding box, in lattice order
+        '''
+        lat0 = max(int(np.ceil((south - self.S) / self.d_lat)), 0)
+        lat1 = min(int(np.floor((north - self.S) / self.d_lat)) + 1, self.N_lat)
+        lon0 = max(int(np.ceil((west - self.W) / self.d_lon)), 0)
+        lon1 = min(int(np.floor((east - self.W) / self.d_lon)) + 1, self.N_lon)
+        if lat0 >= lat1 or lon0 >= lon1:
+            return []
+        window = self.raster[lat0:lat1, lon0:lon1]
+        return window[window != 0].tolist()
+
+
+def load_grid_index(fname):
+    '''
+    Load the grid index, or return None if it has not been generated
+    '''
+    try:
+        return GridIndex.load(fname)
+    except (IOError, OSError) as error:
+        print('Grid index not loaded, using PostGIS: {}'.format(error))
+        return None
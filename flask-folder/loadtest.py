@@ -0,0 +1,129 @@
+'''
+Load test of the dashboard data and download paths
+
+Runs the same mix of concurrent requests against one or more deployments,
+e.g. the gunicorn Procfile app and the native async Tornado app:
+
+    gunicorn --chdir flask-folder app:app -b :8000
+    python flask-folder/tornadoapp.py 8001
+    python flask-folder/loadtest.py http://localhost:8000 http://localhost:8001 \
+        --grid-id 91234 --concurrency 32 --requests 200
+
+and reports throughput plus time-to-first-byte and total latency percentiles
+per endpoint. Both deployments get the same requests: chart lookups are
+GET /api/chart (the request the dashboard page makes), served by Flask under
+gunicorn and by the asyncpg handler under Tornado, and downloads are
+POST /download.
+'''
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+
+# Locations spread over the lattice, for chart lookups
+LOCATIONS = [(41.8781, -87.6298), (40.7128, -74.0060), (34.0522, -118.2437),
+             (29.7604, -95.3698), (47.6062, -122.3321), (39.7392, -104.9903),
+             (25.7617, -80.1918), (44.9778, -93.2650)]
+
+
+def timed_request(method, url, **kwargs):
+    '''
+    Send a request and read the body in chunks
+
+    Returns
+    -------
+    tuple
+            (status code, seconds to first byte, total seconds, bytes read)
+    '''
+    start = time.time()
+    response = requests.request(method, url, stream=True, timeout=600, **kwargs)
+    first_byte = None
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        if first_byte is None:
+            first_byte = time.time() - start
+        size += len(chunk)
+    total = time.time() - start
+    return response.status_code, first_byte if first_byte is not None else total, total, size
+
+
+def chart_request(base_url):
+    latitude, longitude = random.choice(LOCATIONS)
+    return timed_request('GET', base_url + '/api/chart',
+                         params={'lat': latitude, 'lon': longitude})
+
+
+def download_request(base_url, grid_id, start, end):
+    data = {'grid_id': grid_id}
+    if start:
+        data['start'] = start
+    if end:
+        data['end'] = end
+    return timed_request('POST', base_url + '/download', data=data)
+
+
+def summarize(name, results, seconds):
+    '''
+    Print throughput and latency percentiles of one endpoint
+    '''
+    if not results:
+        return
+    status, ttfb, total, size = (np.array(column) for column in zip(*results))
+    errors = int(np.sum(status >= 400))
+    print('  {:<9} {:>5} req {:>4} err {:>8.1f} req/s {:>10.1f} MB'.format(
+        name, len(results), errors, len(results) / seconds, size.sum() / 1e6))
+    for label, values in (('ttfb', ttfb), ('latency', total)):
+        p50, p90, p99 = np.percentile(values, [50, 90, 99]) * 1000
+        print('    {:<8} p50 {:>8.1f} ms  p90 {:>8.1f} ms  p99 {:>8.1f} ms  max {:>8.1f} ms'
+              .format(label, p50, p90, p99, values.max() * 1000))
+
+
+def run(base_url, args):
+    '''
+    Fire args.requests requests with args.concurrency in flight, a
+    args.download_share fraction of them downloads and the rest chart lookups
+    '''
+    async_api = requests.get(base_url + '/tornado', timeout=10).status_code == 200
+
+    def one(i):
+        if random.random() < args.download_share:
+            return 'download', download_request(base_url, args.grid_id,
+                                                args.start, args.end)
+        return 'chart', chart_request(base_url)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    seconds = time.time() - start
+
+    print('{} ({}), {} requests in {:.1f} s'.format(
+        base_url, 'tornado' if async_api else 'wsgi', len(results), seconds))
+    for name in ('chart', 'download'):
+        summarize(name, [result for kind, result in results if kind == name], seconds)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test of the web app')
+    parser.add_argument('urls', nargs='+',
+                        help='Base URLs of the deployments to compare')
+    parser.add_argument('--grid-id', type=int, required=True,
+                        help='Grid point to download')
+    parser.add_argument('--start', help='First day of downloads, YYYY-MM-DD')
+    parser.add_argument('--end', help='Last day of downloads, YYYY-MM-DD')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--download-share', type=float, default=0.2,
+                        help='Fraction of requests that are downloads')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for url in args.urls:
+        random.seed(args.seed)
+        run(url.rstrip('/'), args)
@@ -0,0 +1,175 @@
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class RasterStore(object):
+    '''
+    Monthly rasters written by spark/monthly_rasters.py, one .npy file per
+    weather code and month under root, e.g. root/62101/2021-07.npy
+
+    root is a local directory or s3://bucket/prefix. S3 rasters are copied
+    to cache_dir and served from there; a copy is revalidated against the
+    bucket (by ETag) at most every refresh seconds.
+
+    Rasters are memory-mapped and the most recently used ones kept open.
+    An entry is keyed by the file's modification time and size, so a
+    raster rewritten by the batch job is picked up on the next request.
+    '''
+
+    def __init__(self, root, maxsize=64, cache_dir=None, refresh=300):
+        self.root = root
+        self.maxsize = maxsize
+        self.refresh = refresh
+        self._entries = OrderedDict()
+        self._checked = {}
+        self._lock = threading.Lock()
+        self.bucket = None
+        if root.startswith('s3://') or root.startswith('s3a://'):
+            self.bucket, _, prefix = root.split('://', 1)[1].partition('/')
+            self.prefix = prefix.strip('/')
+            self.local_root = cache_dir
+        else:
+            self.local_root = root
+
+    def key(self, parameter, month):
+        return '{}/{:%Y-%m}.npy'.format(parameter, month)
+
+    def path(self, parameter, month):
+        return os.path.join(self.local_root, *self.key(parameter, month).split('/'))
+
+    def fetch(self, parameter, month):
+        '''
+        Make the local file of a raster current, downloading it from S3 if
+        it is missing or changed
+
+        Returns
+        -------
+        str
+                Local path, None if there is no such raster
+        '''
+        fname = self.path(parameter, month)
+        if self.bucket is None:
+            return fname if os.path.isfile(fname) else None
+
+        key = self.key(parameter, month)
+        with self._lock:
+            checked, etag = self._checked.get(key, (None, None))
+        if checked is not None and time.time() - checked < self.refresh\
+                and os.path.isfile(fname):
+            return fname
+
+        import boto3
+        from botocore.exceptions import ClientError
+
+        request = {'Bucket': self.bucket,
+                   'Key': '/'.join(filter(None, [self.prefix, key]))}
+        if etag and os.path.isfile(fname):
+            request['IfNoneMatch'] = etag
+        try:
+            response = boto3.client('s3').get_object(**request)
+        except ClientError as error:
+            code = error.response.get('Error', {}).get('Code')
+            if code in ('304', 'NotModified'):
+                with self._lock:
+                    self._checked[key] = (time.time(), etag)
+                return fname
+            if code in ('404', 'NoSuchKey'):
+                with self._lock:
+                    self._checked.pop(key, None)
+                return None
+            raise
+
+        # Written to a temporary name and renamed, so memory-mapped readers
+        # keep the previous version until they reopen it
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = '{}.{}.{}.tmp'.format(fname, os.getpid(), threading.get_ident())
+        with open(tmp_fname, 'wb') as f:
+            for chunk in response['Body'].iter_chunks():
+                f.write(chunk)
+        os.replace(tmp_fname, fname)
+        with self._lock:
+            self._checked[key] = (time.time(), response.get('ETag'))
+        return fname
+
+    def load(self, parameter, month):
+        '''
+        Raster of a weather code and month
+
+        Returns
+        -------
+        tuple
+                (raster, version tag for ETags), (None, None) if there is no
+                raster file
+        '''
+        fname = self.fetch(parameter, month)
+        if fname is None:
+            return None, None
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None, None
+        key = (fname, stat.st_mtime_ns, stat.st_size)
+        version = '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            raster = self._entries.get(key)
+            if raster is not None:
+                self._entries.move_to_end(key)
+                return raster, version
+
+        raster = np.load(fname, mmap_mode='r', allow_pickle=False)
+        with self._lock:
+            self._entries[key] = raster
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return raster, version
+
+
+def tile_pixels(z, x, y, size):
+    '''
+    Latitude (north to south) and longitude (west to east) of the pixel
+    centers of Web Mercator tile z/x/y
+    '''
+    n = 2 ** z
+    fractions = (np.arange(size) + 0.5) / size
+    longitude = (x + fractions) / n * 360. - 180.
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * (y + fractions) / n))))
+    return latitude, longitude
+
+
+def tile(raster, grid_index, z, x, y, size=256):
+    '''
+    Web Mercator tile z/x/y of a lattice raster, nearest lattice point per
+    pixel and NaN off the lattice
+
+    Returns
+    -------
+    numpy.ndarray
+                size x size array, row 0 north; None if the tile does not
+                overlap the lattice
+    '''
+    latitude, longitude = tile_pixels(z, x, y, size)
+    ilat = np.rint((latitude - grid_index.S) / grid_index.d_lat).astype(np.int64)
+    ilon = np.rint((longitude - grid_index.W) / grid_index.d_lon).astype(np.int64)
+    rows = (ilat >= 0) & (ilat < raster.shape[0])
+    cols = (ilon >= 0) & (ilon < raster.shape[1])
+    if not rows.any() or not cols.any():
+        return None
+
+    pixels = np.full((size, size), np.nan, dtype=raster.dtype)
+    pixels[np.ix_(rows, cols)] = raster[np.ix_(ilat[rows], ilon[cols])]
+    return pixels
+
+
+def npy_bytes(array):
+    '''
+    An array serialized in .npy format
+    '''
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
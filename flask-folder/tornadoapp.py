@@ -1,21 +1,240 @@
+import asyncio
+import heapq
+import sys
+
+import asyncpg
 from tornado.wsgi import WSGIContainer
-from tornado.ioloop import IOLoop
-from tornado.web import FallbackHandler, RequestHandler, Application
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.web import FallbackHandler, RequestHandler, Application, HTTPError
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header
+
+import app as flask_app
+import download_formats
 from app import app
+from chart_cache import ChartCache
 
 
 class MainHandler(RequestHandler):
  def get(self):
    self.write("This message comes from Tornado ^_^")
 
+
+def page_ready(response_future):
+    '''
+    Wrap the current page of a Cassandra ResponseFuture in an asyncio future
+
+    The driver calls back from its own event thread, so results are handed
+    to the IOLoop with call_soon_threadsafe
+    '''
+    loop = asyncio.get_event_loop()
+    page = loop.create_future()
+
+    def callback(rows):
+        loop.call_soon_threadsafe(page.set_result, rows)
+
+    def errback(error):
+        loop.call_soon_threadsafe(page.set_exception, error)
+
+    response_future.clear_callbacks()
+    response_future.add_callbacks(callback, errback)
+    return page
+
+
+async def iter_weather_records(session, grid_id, parameter, start, end, budget):
+    '''
+    Async counterpart of app.iter_weather_records: yield
+    (time, parameter, measurement) page by page without blocking the IOLoop,
+    prefetching the next year bucket within budget
+    '''
+    queries = flask_app.weather_year_queries(session, grid_id, parameter, start, end)
+    prefetched = None
+    for i, query in enumerate(queries):
+        response_future = prefetched or budget.start(query)
+        prefetched = budget.start(queries[i + 1], prefetch=True)\
+            if i + 1 < len(queries) else None
+        try:
+            while True:
+                rows = await page_ready(response_future)
+                for record in rows:
+                    yield record.time, parameter, record.measurement
+                if not response_future.has_more_pages:
+                    break
+                response_future.start_fetching_next_page()
+        finally:
+            budget.done()
+
+
+async def merge_records(streams):
+    '''
+    k-way merge of time-ordered async record streams, grouped by time
+
+    Yields
+    ------
+    tuple
+            (time, dict of weather code to measurement)
+    '''
+    # First records of all streams concurrently, so their first pages are
+    # awaited together rather than one stream after the other
+    firsts = await asyncio.gather(*[stream.__anext__() for stream in streams],
+                                  return_exceptions=True)
+    heads = []
+    for i, record in enumerate(firsts):
+        if isinstance(record, StopAsyncIteration):
+            continue
+        if isinstance(record, BaseException):
+            raise record
+        heads.append((record[0], i, record))
+    heapq.heapify(heads)
+
+    time, record_values = None, {}
+    while heads:
+        record_time, i, record = heapq.heappop(heads)
+        if record_time != time:
+            if record_values:
+                yield time, record_values
+            time, record_values = record_time, {}
+        record_values[record[1]] = record[2]
+        async for record in streams[i]:
+            heapq.heappush(heads, (record[0], i, record))
+            break
+    if record_values:
+        yield time, record_values
+
+
+class ArgumentsForm(object):
+    '''
+    Read-only view of Tornado request arguments with the get/getlist
+    interface of a Flask form, for app.parse_download_options
+    '''
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def get(self, name, default=None):
+        return self.handler.get_argument(name, default)
+
+    def getlist(self, name):
+        return self.handler.get_arguments(name)
+
+
+class DownloadHandler(RequestHandler):
+    '''
+    Non-blocking /download: Cassandra pages are awaited and the encoded
+    download is flushed chunk by chunk, so long downloads do not block
+    other requests
+    '''
+
+    def get(self):
+        self.redirect('/')
+
+    async def post(self):
+        grid_id = self.get_argument('grid_id')
+        try:
+            codes, start, end = flask_app.parse_download_options(ArgumentsForm(self))
+        except HTTPException as error:
+            raise HTTPError(400, error.description)
+        download_format = download_formats.negotiate_format(
+            self.get_argument('format', None),
+            parse_accept_header(self.request.headers.get('Accept'), MIMEAccept))
+        if download_format is None:
+            raise HTTPError(400, 'Unknown download format')
+        codes = codes or flask_app.weather_codes
+        default_start, default_end = flask_app.history_range()
+        start = start or default_start
+        end = end or default_end
+
+        mimetype, extension = download_formats.FORMATS[download_format]
+        self.set_header('Content-Type', mimetype)
+        self.set_header('Content-Disposition',
+                        'attachment; filename=data_grid_{}.{}'.format(grid_id, extension))
+        self.set_header('Vary', 'Accept')
+
+        session = flask_app.get_cassandra_session()
+        budget = flask_app.QueryBudget(app.config["CASSANDRA_MAX_IN_FLIGHT"])
+        streams = [iter_weather_records(session, grid_id, code, start, end, budget)
+                   for code in codes]
+        encoder = download_formats.make_encoder(
+            download_format, codes, flask_app.weather_headers,
+            flask_app.weather_columns, flask_app.get_measurements)
+
+        rows = []
+        async for row in merge_records(streams):
+            rows.append(row)
+            if len(rows) >= encoder.rows:
+                self.write(encoder.encode(rows))
+                rows = []
+                await self.flush()
+        self.write(encoder.encode(rows) + encoder.finish())
+
+
+class ChartDataHandler(RequestHandler):
+    '''
+    Async counterpart of app.chart_data: dashboard chart series for a
+    location as JSON, read from chart_series with an async PostgreSQL client
+
+    GET /api/chart?lat=..&lon=..
+    '''
+
+    async def get(self):
+        try:
+            latitude = float(self.get_argument('lat'))
+            longitude = float(self.get_argument('lon'))
+        except ValueError:
+            raise HTTPError(400, 'lat and lon must be numbers')
+
+        sql, params, key = flask_app.chart_series_query(latitude, longitude)
+
+        result = chart_cache.get(key)
+        if result is None:
+            pool = self.application.settings['pg_pool']
+            rows = await pool.fetch(*flask_app.positional_query(sql, params))
+            if rows:
+                result = rows[0]['grid_id'], {row['parameter']: row['payload'] for row in rows}
+            else:
+                result = None, {}
+            chart_cache.put(key, result)
+
+        grid_id, series = result
+        if grid_id is None:
+            raise HTTPError(404, 'No weather history near this location')
+        self.set_header('Content-Type', 'application/json')
+        self.write(flask_app.chart_json(grid_id, series))
+
+
+# Load generation of the monthly data, refreshed in the background so
+# cache lookups never wait on the database
+current_generation = [None]
+chart_cache = ChartCache(maxsize=app.config["CHART_CACHE_SIZE"],
+                         ttl=app.config["CHART_CACHE_TTL"],
+                         generation_fn=lambda: current_generation[0],
+                         generation_interval=0)
+
+
+async def refresh_generation(pool):
+    current_generation[0] = await pool.fetchval("SELECT generation FROM load_generation;")
+
+
 tr = WSGIContainer(app)
 
-application = Application([
-(r"/tornado", MainHandler),
-(r".*", FallbackHandler, dict(fallback=tr)),
-])
 
-if __name__ == "__main__":
- application.listen(80)
- IOLoop.instance().start()
+async def make_application():
+    pool = await asyncpg.create_pool(app.config["SQLALCHEMY_DATABASE_URI"],
+                                     min_size=2, max_size=10)
+    await refresh_generation(pool)
+    PeriodicCallback(lambda: refresh_generation(pool),
+                     app.config["CHART_CACHE_GENERATION_INTERVAL"] * 1000).start()
+    return Application([
+        (r"/tornado", MainHandler),
+        (r"/download", DownloadHandler),
+        (r"/api/chart", ChartDataHandler),
+        (r".*", FallbackHandler, dict(fallback=tr)),
+    ], pg_pool=pool)
 
+
+if __name__ == "__main__":
+ port = int(sys.argv[1]) if len(sys.argv) > 1 else 80
+ application = IOLoop.current().run_sync(make_application)
+ application.listen(port)
+ IOLoop.current().start()
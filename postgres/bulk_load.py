@@ -0,0 +1,280 @@
+import csv
+from io import StringIO
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import psycopg2
+
+
+# Rebuild the dashboard series of the grid points loaded since the last
+# refresh, then bump the generation so cached series are invalidated.
+# The dirty grid points are deleted by the rebuild statement itself, so
+# points marked by a load that commits meanwhile stay for the next refresh
+REFRESH_CHART_SERIES = """
+    WITH dirty AS (DELETE FROM chart_series_dirty RETURNING grid_id)
+    INSERT INTO chart_series (grid_id, parameter, payload)
+    SELECT m.grid_id, m.parameter,
+           json_agg(json_build_array((extract(epoch FROM m.time) * 1000)::bigint,
+                                     round(m.c::numeric, 2))
+                    ORDER BY m.time)::text
+    FROM measurements_monthly m JOIN dirty d USING (grid_id)
+    GROUP BY m.grid_id, m.parameter
+    ON CONFLICT (grid_id, parameter) DO UPDATE SET payload = EXCLUDED.payload;
+    UPDATE load_generation SET generation = generation + 1;
+    """
+
+
+def batches(rows, batch_size):
+    '''
+    Split an iterable of rows into lists of at most batch_size rows
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def copy_rows(cur, table, columns, rows):
+    '''
+    Stream rows into a table with COPY ... FROM STDIN in CSV format
+
+    Parameters
+    ----------
+    cur : cursor
+                psycopg2 cursor
+    table : str
+                Name of the table to copy into
+    columns : list
+                Column names, in the order of the row fields
+    rows : list
+                Tuples of values; None is written as NULL
+
+    Returns
+    -------
+    int
+                Number of rows copied
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+    buf.seek(0)
+    cur.copy_expert(
+        "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ', '.join(columns)),
+        buf
+    )
+    return len(rows)
+
+
+def parallel_copy(dsn, table, columns, rows, batch_size=50000, parallelism=4):
+    '''
+    Copy rows into a table in batches over several connections
+
+    Each worker thread opens its own connection and commits every batch,
+    so the table should be a staging table that is merged afterwards.
+
+    Parameters
+    ----------
+    dsn : str or dict
+                Connection string, or dict of psycopg2.connect arguments
+    table : str
+                Name of the table to copy into
+    columns : list
+                Column names, in the order of the row fields
+    rows : iterable
+                Tuples of values
+    batch_size : int
+                Rows per COPY statement
+    parallelism : int
+                Number of concurrent connections
+
+    Returns
+    -------
+    int
+                Number of rows copied
+    '''
+    def copy_batch(batch):
+        conn = connect(dsn)
+        try:
+            cur = conn.cursor()
+            n = copy_rows(cur, table, columns, batch)
+            conn.commit()
+            cur.close()
+            return n
+        finally:
+            conn.close()
+
+    # At most two batches per connection are built ahead of the COPYs,
+    # so memory does not grow with the number of rows
+    n = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for batch in batches(rows, batch_size):
+            if len(pending) >= 2 * parallelism:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                n += sum(future.result() for future in done)
+            pending.add(executor.submit(copy_batch, batch))
+        n += sum(future.result() for future in pending)
+    return n
+
+
+def connect(dsn):
+    '''
+    Open a psycopg2 connection from a connection string or a dict
+    '''
+    if isinstance(dsn, dict):
+        return psycopg2.connect(**dsn)
+    return psycopg2.connect(dsn)
+
+
+def load_grid(dsn, grid, batch_size=50000, parallelism=4):
+    '''
+    Bulk load grid points and build their geography in one statement
+
+    Parameters
+    ----------
+    dsn : str or dict
+                Connection string, or dict of psycopg2.connect arguments
+    grid : list
+                Grid points, dicts with "id", "lon" and "lat"
+    batch_size : int
+                Rows per COPY statement
+    parallelism : int
+                Number of concurrent COPY connections
+
+    Returns
+    -------
+    int
+                Number of grid points loaded
+    '''
+    conn = connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            DROP TABLE IF EXISTS grid_staging;
+            CREATE UNLOGGED TABLE grid_staging (
+                grid_id INT NOT NULL,
+                longitude float8 NOT NULL,
+                latitude float8 NOT NULL);
+            """
+        )
+        conn.commit()
+
+        rows = ((point["id"], point["lon"], point["lat"]) for point in grid)
+        n = parallel_copy(dsn, 'grid_staging', ['grid_id', 'longitude', 'latitude'],
+                          rows, batch_size, parallelism)
+        print("copied {} grid points".format(n))
+
+        cur.execute(
+            """
+            INSERT INTO grid (grid_id, longitude, latitude, location)
+            SELECT grid_id, longitude, latitude,
+                   ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography
+            FROM grid_staging;
+            DROP TABLE grid_staging;
+            """
+        )
+        conn.commit()
+        cur.close()
+        return n
+    finally:
+        conn.close()
+
+
+def load_monthly(conn, rows, batch_size=50000):
+    '''
+    Bulk load monthly measurements through a temporary staging table
+
+    Parameters
+    ----------
+    conn : connection
+                psycopg2 connection; the load is committed on success
+    rows : iterable
+                Tuples (grid_id, time, parameter, C)
+    batch_size : int
+                Rows per COPY statement
+
+    Returns
+    -------
+    int
+                Number of rows copied
+    '''
+    cur = conn.cursor()
+    cur.execute(
+        """
+        CREATE TEMP TABLE measurements_monthly_staging
+            (LIKE measurements_monthly INCLUDING DEFAULTS) ON COMMIT DROP;
+        """
+    )
+    n = 0
+    for batch in batches(rows, batch_size):
+        n += copy_rows(cur, 'measurements_monthly_staging',
+                       ['grid_id', 'time', 'parameter', 'c'], batch)
+    upsert_monthly(cur, 'measurements_monthly_staging')
+    conn.commit()
+    cur.close()
+    return n
+
+
+def upsert_monthly(cur, staging_table):
+    '''
+    Merge a staging table into measurements_monthly in one statement
+
+    Existing (grid_id, time, parameter) rows get the new value, so re-running
+    a month is idempotent and costs as much as the batch, not the table.
+    grid_coverage gets the (grid_id, parameter) pairs of the batch and
+    chart_series_dirty its grid points, see refresh_chart_series; both in
+    key order, so concurrent loads take their locks in the same order.
+    '''
+    cur.execute(
+        """
+        INSERT INTO measurements_monthly (grid_id, time, parameter, c)
+        SELECT grid_id, time, parameter, c FROM {staging}
+        ON CONFLICT (grid_id, time, parameter) DO UPDATE SET c = EXCLUDED.c;
+        INSERT INTO grid_coverage (grid_id, parameter)
+        SELECT DISTINCT grid_id, parameter FROM {staging}
+        ORDER BY grid_id, parameter
+        ON CONFLICT DO NOTHING;
+        INSERT INTO chart_series_dirty (grid_id)
+        SELECT DISTINCT grid_id FROM {staging}
+        ORDER BY grid_id
+        ON CONFLICT DO NOTHING;
+        """.format(staging=staging_table)
+    )
+
+
+def refresh_chart_series(dsn):
+    '''
+    Materialize the dashboard series of the grid points loaded since the
+    last refresh; run once after all partitions of a load are written
+    '''
+    conn = connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(REFRESH_CHART_SERIES)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+
+def write_monthly_partition(rows, dsn, batch_size=50000):
+    '''
+    Spark foreachPartition writer: one connection and one COPY stream
+    per partition of (grid_id, time, parameter, C) records
+
+    Returns
+    -------
+    int
+                Number of rows copied
+    '''
+    conn = connect(dsn)
+    try:
+        n = load_monthly(conn, rows, batch_size)
+        print("copied {} monthly records".format(n))
+    finally:
+        conn.close()
+    return n
@@ -1,17 +1,80 @@
+import argparse
 import configparser
 import psycopg2
 import sys
 import os
 
+from bulk_load import REFRESH_CHART_SERIES
+
+
+# Weather parameter codes with their own partitions of measurements_monthly
+PARAMETERS = {64101: 'pressure', 61103: 'wind', 62101: 'temp', 62201: 'humidity'}
+# First years of the decades partitioning each parameter by time
+DECADES = range(1980, 2030, 10)
+
+
+def monthly_table_commands(table='measurements_monthly'):
+    '''
+    DDL for measurements_monthly partitioned by parameter, then by decade
+
+    The primary key leads with (grid_id, parameter), so a dashboard lookup
+    is one index range scan per partition, and the BRIN index on time keeps
+    yearly reloads and range scans cheap. Unknown parameters and years land
+    in DEFAULT partitions.
+    '''
+    commands = [
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            grid_id INT NOT NULL REFERENCES grid (grid_id) ON DELETE CASCADE,
+            time TIMESTAMP NOT NULL,
+            parameter INT NOT NULL,
+            C REAL,
+            PRIMARY KEY (grid_id, parameter, time) )
+        PARTITION BY LIST (parameter);
+        CREATE INDEX IF NOT EXISTS {table}_time_brin ON {table} USING BRIN (time);
+        """.format(table=table)
+    ]
+    for code, name in sorted(PARAMETERS.items()):
+        parameter_table = '{}_{}'.format(table, name)
+        commands.append(
+            """
+            CREATE TABLE IF NOT EXISTS {parameter_table} PARTITION OF {table}
+                FOR VALUES IN ({code}) PARTITION BY RANGE (time);
+            CREATE TABLE IF NOT EXISTS {parameter_table}_default
+                PARTITION OF {parameter_table} DEFAULT;
+            """.format(**locals())
+        )
+        for decade in DECADES:
+            commands.append(
+                """
+                CREATE TABLE IF NOT EXISTS {parameter_table}_{decade}s
+                    PARTITION OF {parameter_table}
+                    FOR VALUES FROM ('{decade}-01-01') TO ('{end}-01-01');
+                """.format(parameter_table=parameter_table, decade=decade,
+                            end=decade + 10)
+            )
+    commands.append(
+        """
+        CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;
+        """.format(table=table)
+    )
+    return commands
+
 
 def create_tables():
     '''
     Create tables in the PostgreSQL database
     '''
+    # Duplicate monthly records are handled by INSERT ... ON CONFLICT
+    # in bulk_load.upsert_monthly rather than by a per-row RULE
     commands = (
         """
         DROP TABLE IF EXISTS grid CASCADE;
         DROP TABLE IF EXISTS measurements_monthly;
+        DROP TABLE IF EXISTS grid_coverage;
+        DROP TABLE IF EXISTS chart_series;
+        DROP TABLE IF EXISTS chart_series_dirty;
+        DROP TABLE IF EXISTS load_generation;
         """,
         """
         CREATE TABLE IF NOT EXISTS grid (
@@ -20,19 +83,139 @@ def create_tables():
             latitude float4 NOT NULL,
             location geography(POINT) NOT NULL);
         """,
+    ) + tuple(monthly_table_commands()) + (coverage_table_command(),
+                                            chart_series_table_command())
+    execute_commands(commands)
+
+
+def chart_series_table_command():
+    '''
+    DDL for the materialized dashboard series
+
+    chart_series holds each grid point's monthly series per parameter as a
+    pre-serialized JSON array of [epoch ms, value]. The batch job marks the
+    grid points it loads in chart_series_dirty, rebuilds their series with
+    bulk_load.refresh_chart_series and bumps load_generation, which the web
+    app uses to invalidate its cache.
+    '''
+    return """
+        CREATE TABLE IF NOT EXISTS chart_series (
+            grid_id INT NOT NULL REFERENCES grid (grid_id) ON DELETE CASCADE,
+            parameter INT NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (grid_id, parameter) );
+        CREATE TABLE IF NOT EXISTS chart_series_dirty (
+            grid_id INT PRIMARY KEY );
+        CREATE TABLE IF NOT EXISTS load_generation (
+            id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            generation BIGINT NOT NULL );
+        INSERT INTO load_generation (id, generation) VALUES (1, 0)
+            ON CONFLICT DO NOTHING;
         """
-        CREATE TABLE IF NOT EXISTS measurements_monthly (
+
+
+def migrate_chart_series():
+    '''
+    Create the chart series tables in an existing database and
+    materialize the series of every grid point with data
+    '''
+    commands = (
+        chart_series_table_command(),
+        """
+        INSERT INTO chart_series_dirty (grid_id)
+        SELECT DISTINCT grid_id FROM grid_coverage
+        ON CONFLICT DO NOTHING;
+        """,
+        REFRESH_CHART_SERIES,
+    )
+    execute_commands(commands)
+
+
+def coverage_table_command():
+    '''
+    DDL for grid_coverage, the (grid_id, parameter) pairs with monthly data
+
+    The batch job adds pairs as it loads measurements_monthly, so the
+    dashboard finds the nearest grid point with data in one query
+    '''
+    return """
+        CREATE TABLE IF NOT EXISTS grid_coverage (
             grid_id INT NOT NULL REFERENCES grid (grid_id) ON DELETE CASCADE,
-            time TIMESTAMP NOT NULL,
             parameter INT NOT NULL,
-            C REAL,
-            PRIMARY KEY (grid_id, time, parameter) );
-        CREATE RULE "measurements_monthly_on_duplicate_ignore" AS ON INSERT TO "measurements_monthly"
-            WHERE EXISTS(SELECT 1 FROM measurements_monthly
-                WHERE (grid_id, time, parameter)=(NEW.grid_id, NEW.time, NEW.parameter))
-            DO INSTEAD NOTHING;
+            PRIMARY KEY (grid_id, parameter) );
+        """
+
+
+def migrate_coverage():
+    '''
+    Create grid_coverage in an existing database and fill it from
+    measurements_monthly
+    '''
+    commands = (
+        coverage_table_command(),
+        """
+        INSERT INTO grid_coverage (grid_id, parameter)
+        SELECT DISTINCT grid_id, parameter FROM measurements_monthly
+        ON CONFLICT DO NOTHING;
+        """,
+    )
+    execute_commands(commands)
+
+
+def migrate_drop_duplicate_rule():
+    '''
+    Drop the per-row duplicate-ignore RULE from an existing database
+
+    INSERT ... ON CONFLICT cannot be used on a table with INSERT rules
+    '''
+    commands = (
         """
+        DROP RULE IF EXISTS "measurements_monthly_on_duplicate_ignore" ON measurements_monthly;
+        """,
     )
+    execute_commands(commands)
+
+
+def migrate_partition_monthly():
+    '''
+    Move an existing single-heap measurements_monthly into the
+    partitioned layout of monthly_table_commands
+
+    The table is only moved while it is a plain heap (pg_class.relkind
+    'r'), so running the migration on a partitioned table does nothing
+    '''
+    commands = (
+        """
+        DO $$
+        BEGIN
+            IF (SELECT relkind FROM pg_class
+                WHERE oid = to_regclass('measurements_monthly')) = 'r' THEN
+                ALTER TABLE measurements_monthly RENAME TO measurements_monthly_heap;
+                ALTER TABLE measurements_monthly_heap
+                    RENAME CONSTRAINT measurements_monthly_pkey TO measurements_monthly_heap_pkey;
+            END IF;
+        END $$;
+        """,
+    ) + tuple(monthly_table_commands()) + (
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('measurements_monthly_heap') IS NOT NULL THEN
+                INSERT INTO measurements_monthly (grid_id, time, parameter, c)
+                SELECT grid_id, time, parameter, c FROM measurements_monthly_heap;
+                DROP TABLE measurements_monthly_heap;
+                ANALYZE measurements_monthly;
+            END IF;
+        END $$;
+        """,
+    )
+    execute_commands(commands)
+
+
+def execute_commands(commands):
+    '''
+    Execute SQL commands in one transaction
+    '''
 
     # Read in configuration file
 
@@ -69,4 +252,15 @@ def create_tables():
 
 
 if __name__ == '__main__':
-    create_tables()
+    parser = argparse.ArgumentParser(description='Create or migrate PostgreSQL tables')
+    parser.add_argument('--migrate', action='store_true',
+                        help='Migrate an existing database instead of '
+                             'dropping and recreating the tables')
+    args = parser.parse_args()
+    if args.migrate:
+        migrate_drop_duplicate_rule()
+        migrate_partition_monthly()
+        migrate_coverage()
+        migrate_chart_series()
+    else:
+        create_tables()
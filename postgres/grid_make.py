@@ -1,50 +1,33 @@
+import argparse
 import configparser
-import numpy
 import json
-import psycopg2
-import sys
-import os
 
+from bulk_load import load_grid
 
-def insert_records(commands):
+
+def get_postgres_url():
     '''
-    Insert grid points into the database
+    Build the PostgreSQL connection string from the configuration file
     '''
     # Read in configuration file
 
     config = configparser.ConfigParser()
     config.read('../setup.cfg')
 
-    postgres_url = 'postgresql://'\
-                   + config["postgres"]["user"] + ':' + config["postgres"]["password"]\
-                   + '@localhost:' + config["postgres"]["port"] + '/' + config["postgres"]["db"]
-
-    conn = None
-    try:
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(postgres_url)
-        cur = conn.cursor()
-        # create table one by one
-        print("got connection")
-        for command in commands:
-            cur.execute(command)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        print("closed the cursor")
-        # commit the changes
-        conn.commit()
-        print("committed the connection")
-    except (Exception) as error:
-        print(error)
-        raise error
-    finally:
-        if conn is not None:
-            conn.close()
-            print("closed the connection")
+    return 'postgresql://'\
+        + config["postgres"]["user"] + ':' + config["postgres"]["password"]\
+        + '@localhost:' + config["postgres"]["port"] + '/' + config["postgres"]["db"]
 
 
 def main():
 
+    parser = argparse.ArgumentParser(description='Load grid points into PostgreSQL')
+    parser.add_argument('--batch-size', type=int, default=50000,
+                        help='Grid points per COPY statement')
+    parser.add_argument('--parallelism', type=int, default=4,
+                        help='Number of concurrent COPY connections')
+    args = parser.parse_args()
+
     # File from which to read json
     fname = 'grid.json'
 
@@ -54,18 +37,10 @@ def main():
 
     GRID = json.loads(raw_json)
 
-    commands = []
-
-    for grid in GRID:
-        grid_id = grid["id"]
-        longitude = grid["lon"]
-        latitude = grid["lat"]
-        commands.append(
-        """
-        INSERT INTO grid (grid_id, longitude, latitude, location) VALUES ({grid_id}, {longitude}, {latitude}, ST_GeogFromText('POINT({longitude} {latitude})') );
-        """.format(**locals())
-        )
-    insert_records(commands)
+    # COPY into a staging table, then build the geography column
+    # for all grid points in a single INSERT ... SELECT
+    n = load_grid(get_postgres_url(), GRID, args.batch_size, args.parallelism)
+    print("loaded {} grid points".format(n))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+import time
+from collections import deque
+from itertools import groupby
+
+
+# Hourly tables: INSERT statement, partition key of a row and bind values.
+# parameter is a text column, read back as parameter = '<code>'
+HOURLY_TABLES = {
+    'table_hourly': (
+        "INSERT INTO weather.table_hourly (grid_id, parameter, time, measurement) "
+        "VALUES (?, ?, ?, ?)",
+        lambda row: (row[0], row[1]),
+        lambda row: (row[0], str(row[1]), row[2], row[3])
+    ),
+    # One partition per grid point, parameter and year
+    'table_hourly_by_year': (
+        "INSERT INTO weather.table_hourly_by_year "
+        "(grid_id, parameter, year, time, measurement) VALUES (?, ?, ?, ?, ?)",
+        lambda row: (row[0], row[1], row[2].year),
+        lambda row: (row[0], str(row[1]), row[2].year, row[2], row[3])
+    ),
+}
+
+# Partition key columns of each hourly table, as names of the Spark
+# columns the rows must be clustered and sorted by (year is the year of time)
+PARTITION_COLUMNS = {
+    'table_hourly': ('grid_id', 'parameter'),
+    'table_hourly_by_year': ('grid_id', 'parameter', 'year'),
+}
+
+
+class SinkStats(object):
+    '''
+    Counters of an hourly write: rows and batches written, retried batches
+    and batches that failed after all retries, plus elapsed seconds
+    '''
+
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.failures = 0
+        self.seconds = 0.
+
+    def __repr__(self):
+        rate = self.rows / self.seconds if self.seconds else 0.
+        return '<{} rows in {} batches, {} retries, {} failures, {:.0f} rows/s>'\
+            .format(self.rows, self.batches, self.retries, self.failures, rate)
+
+
+# Sessions opened in this process, keyed by connection settings
+_SESSIONS = {}
+
+
+def connect(contact_points=None, port=9042, secure_bundle=None,
+            username=None, password=None):
+    '''
+    Open (once per process) a Cassandra session
+
+    Parameters
+    ----------
+    contact_points : list, optional
+                Hosts of a self-managed cluster, e.g. ['127.0.0.1'] for a
+                local single-node instance
+    port : int
+                Native protocol port of contact_points
+    secure_bundle : str, optional
+                Path of an Astra secure connect bundle, used when no
+                contact points are given
+    username, password : str, optional
+                Credentials for PlainTextAuthProvider
+
+    Returns
+    -------
+    Session
+    '''
+    from cassandra.cluster import Cluster
+    from cassandra.auth import PlainTextAuthProvider
+
+    key = (tuple(contact_points or ()), port, secure_bundle, username)
+    session = _SESSIONS.get(key)
+    if session is None:
+        auth_provider = PlainTextAuthProvider(username, password)\
+            if username else None
+        if contact_points:
+            cluster = Cluster(contact_points, port=port, auth_provider=auth_provider)
+        else:
+            cluster = Cluster(cloud={'secure_connect_bundle': secure_bundle},
+                              auth_provider=auth_provider)
+        session = cluster.connect()
+        _SESSIONS[key] = session
+    return session
+
+
+def partition_batches(rows, max_batch_rows, partition_key):
+    '''
+    Split rows into chunks of at most max_batch_rows rows of a single
+    Cassandra partition
+
+    Rows are consumed as a stream: they must already arrive grouped by
+    partition key (e.g. sorted in Spark, see raw_batch.write_hourly_to_cassandra),
+    and only one chunk is held in memory at a time
+
+    Parameters
+    ----------
+    rows : iterable
+                Tuples (grid_id, parameter, timestamp, C), grouped by
+                partition key
+    max_batch_rows : int
+                Largest number of rows per chunk
+    partition_key : callable
+                Maps a row to its partition key
+
+    Yields
+    ------
+    list
+                Rows of a single partition
+    '''
+    for _, partition in groupby(rows, key=partition_key):
+        chunk = []
+        for row in partition:
+            chunk.append(row)
+            if len(chunk) >= max_batch_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def write_hourly(session, rows, max_batch_rows=100, concurrency=16,
+                 max_retries=3, stats=None, table='table_hourly_by_year'):
+    '''
+    Write hourly grid values with unlogged per-partition batches
+
+    Every batch only touches one partition, so it goes to a single replica
+    set without the batch log. At most `concurrency` batches are in flight;
+    a failed batch is resubmitted up to max_retries times.
+
+    Parameters
+    ----------
+    session : Session
+                Cassandra session, or any object with prepare() and
+                execute_async() returning futures with result()
+    rows : iterable
+                Tuples (grid_id, parameter, timestamp, C), grouped by the
+                table's partition key (see PARTITION_COLUMNS)
+    max_batch_rows : int
+                Largest number of rows per batch
+    concurrency : int
+                Largest number of batches in flight
+    max_retries : int
+                Retries of a failed batch before it is counted as failed
+    stats : SinkStats, optional
+                Counters to update
+    table : str
+                Target table, a key of HOURLY_TABLES
+
+    Returns
+    -------
+    SinkStats
+    '''
+    from cassandra.query import BatchStatement, BatchType
+
+    if stats is None:
+        stats = SinkStats()
+    insert_cql, partition_key, bind = HOURLY_TABLES[table]
+    insert = session.prepare(insert_cql)
+    start = time.time()
+
+    def submit(batch_rows, attempt):
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for row in batch_rows:
+            batch.add(insert, bind(row))
+        in_flight.append((session.execute_async(batch), batch_rows, attempt))
+
+    def wait_oldest():
+        future, batch_rows, attempt = in_flight.popleft()
+        try:
+            future.result()
+        except Exception as error:
+            if attempt < max_retries:
+                stats.retries += 1
+                submit(batch_rows, attempt + 1)
+            else:
+                stats.failures += 1
+                print('Failed to write {} rows: {}'.format(len(batch_rows), error))
+            return
+        stats.rows += len(batch_rows)
+        stats.batches += 1
+
+    in_flight = deque()
+    for batch_rows in partition_batches(rows, max_batch_rows, partition_key):
+        while len(in_flight) >= concurrency:
+            wait_oldest()
+        submit(batch_rows, 0)
+    while in_flight:
+        wait_oldest()
+
+    stats.seconds += time.time() - start
+    return stats
@@ -7,6 +7,9 @@ import configparser
 
 from pyspark import SparkContext, SparkConf
 
+from grid_neighbors import GridArrays, block_station_neighbors
+from station_table import StationTable
+
 '''
 True for a string that represents a nonzero float or int
 This function is used to test our latitude and longitude values
@@ -134,6 +137,11 @@ def determine_grid_point_neighbors(rdd):
             adjacent_grid_points[grid_id] = round(d, precision)
     return (station_id, adjacent_grid_points)
 
+def determine_grid_point_neighbors_block(stations):
+    # Vectorized equivalent of determine_grid_point_neighbors
+    # applied to a whole partition of stations, a block at a time
+    return block_station_neighbors(GRID_ARRAYS, list(stations))
+
 def main():
     # Read in data from the configuration files
 
@@ -159,22 +167,27 @@ def main():
     with open('grid.json', 'r') as f:
         raw_json = f.readline()
 
-    global GRID
+    global GRID, GRID_ARRAYS
     GRID = json.loads(raw_json)
+    GRID_ARRAYS = GridArrays(GRID)
 
     # This is the file of measurement stations from the EPA
     data_file = 'aqs_sites.csv'
     raw = s3 + data_file
 
     data_rdd = sc.textFile(raw, 3)
+    sc.addPyFile('grid_neighbors.py')
 
     stations = data_rdd.map(parse_station_record)\
                        .filter(lambda line: line is not None)\
-                       .map(determine_grid_point_neighbors)\
+                       .mapPartitions(determine_grid_point_neighbors_block)\
                        .collectAsMap()
 
     with open('stations.json', 'w') as f:
         json.dump(stations, f)
 
+    # Compact CSR copy of the same table for the batch job
+    StationTable.from_neighbors(stations).save('stations_csr')
+
 if __name__ == '__main__':
     main()
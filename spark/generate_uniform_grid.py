@@ -1,6 +1,6 @@
 import json
-import shapefile
-from point_location import in_us
+import numpy as np
+from point_location import states_for_points
 
 N = 72.
 S = 18.
@@ -13,17 +13,35 @@ N_lon = 860
 d_lat = (N-S)/float(N_lat)
 d_lon = (E-W)/float(N_lon)
 
-grid = []
-grid_id = 0
 precision = 3
-for ilat in range(0, N_lat):
-    for ilon in range(0, N_lon):
-        lat = S + d_lat*ilat
-        lon = W + d_lon*ilon
-        if in_us(lat, lon):
-            grid_id += 1
-            grid.append({"id": grid_id, "lat": round(lat, precision), "lon": round(lon, precision)})
-
-print(grid_id)
-with open('grid.json', 'w') as f:
-    json.dump(grid, f)
+
+
+def main():
+    # Whole lattice at once, row-major in (ilat, ilon) like the original loops
+    ilat, ilon = np.meshgrid(np.arange(N_lat), np.arange(N_lon), indexing='ij')
+    lat = S + d_lat*ilat.ravel()
+    lon = W + d_lon*ilon.ravel()
+    in_us = states_for_points(lat, lon) != None
+
+    grid = []
+    grid_id = 0
+    # (ilat, ilon) -> grid_id raster, 0 outside the U.S.
+    raster = np.zeros(N_lat * N_lon, dtype=np.int32)
+    for i in np.flatnonzero(in_us):
+        grid_id += 1
+        raster[i] = grid_id
+        grid.append({"id": grid_id,
+                     "lat": round(float(lat[i]), precision),
+                     "lon": round(float(lon[i]), precision)})
+
+    print(grid_id)
+    with open('grid.json', 'w') as f:
+        json.dump(grid, f)
+
+    # Index for arithmetic nearest-grid lookups in the web app
+    np.savez('grid_index.npz', raster=raster.reshape(N_lat, N_lon),
+             N=N, S=S, W=W, E=E)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import json
+import sys
+import time
+from math import radians
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+R = 3959.  # Earth's radius in miles, same as compile_stations.calc_distance
+D_CUTOFF = 30.
+PRECISION = 1  # Store one decimal point for distance in miles
+
+
+class GridArrays(object):
+    '''
+    Grid points held as contiguous float arrays for vectorized distance search
+
+    Latitudes and longitudes are stored pre-converted to radians together
+    with cos(latitude), so a haversine pass costs three trigonometric array
+    operations instead of five scalar calls per grid point. A KD-tree over
+    the grid's 3D unit vectors limits each pass to the grid points within
+    the cutoff chord of the station.
+    '''
+
+    def __init__(self, grid):
+        '''
+        Parameters
+        ----------
+        grid : list
+                    List of grid points, dicts with "id", "lat" and "lon",
+                    as written by generate_uniform_grid.py
+        '''
+        self.ids = np.array([point["id"] for point in grid], dtype=np.int64)
+        lat = np.array([point["lat"] for point in grid], dtype=np.float64)
+        lon = np.array([point["lon"] for point in grid], dtype=np.float64)
+        self.lat = np.radians(lat)
+        self.lon = np.radians(lon)
+        self.cos_lat = np.cos(self.lat)
+        self.tree = cKDTree(unit_vectors(self.lat, self.lon))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, latitude, longitude, index=None):
+        '''
+        Haversine distance in miles from one point to grid points
+
+        Parameters
+        ----------
+        latitude, longitude : float
+                    Coordinates of the point in degrees
+        index : ndarray, optional
+                    Positions of the grid points to consider, all by default
+
+        Returns
+        -------
+        ndarray
+                    Distances in miles, aligned with index
+        '''
+        lat = radians(latitude)
+        lon = radians(longitude)
+        if index is None:
+            grid_lat, grid_lon, grid_cos = self.lat, self.lon, self.cos_lat
+        else:
+            grid_lat = self.lat[index]
+            grid_lon = self.lon[index]
+            grid_cos = self.cos_lat[index]
+        a = np.sin((lat - grid_lat) / 2.0) ** 2 + \
+            np.cos(lat) * grid_cos * np.sin((lon - grid_lon) / 2.0) ** 2
+        return 2 * R * np.arcsin(np.sqrt(a))
+
+    def candidates(self, latitudes, longitudes, d_cutoff=D_CUTOFF):
+        '''
+        Positions of grid points possibly within d_cutoff of each point
+
+        The KD-tree is queried with the chord length that corresponds to
+        d_cutoff along the great circle, so the work done is proportional
+        to the number of neighbors found rather than to the grid size.
+
+        Parameters
+        ----------
+        latitudes, longitudes : array_like
+                    Coordinates of the points in degrees
+        d_cutoff : float
+                    Search radius in miles
+
+        Returns
+        -------
+        list
+                    One sorted ndarray of grid positions per point
+        '''
+        points = unit_vectors(np.radians(np.asarray(latitudes, dtype=np.float64)),
+                              np.radians(np.asarray(longitudes, dtype=np.float64)))
+        # Small margin so that rounding never drops a point right at the
+        # cutoff; the exact haversine distance filters the candidates
+        chord = 2 * np.sin(d_cutoff / (2 * R)) * (1 + 1e-9)
+        found = self.tree.query_ball_point(points, chord)
+        return [np.sort(np.asarray(index, dtype=np.int64)) for index in found]
+
+
+def unit_vectors(lat, lon):
+    '''
+    Convert latitudes and longitudes in radians to 3D unit vectors
+    '''
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon),
+                            cos_lat * np.sin(lon),
+                            np.sin(lat)))
+
+
+def neighbors_from_distances(ids, d, d_cutoff=D_CUTOFF, precision=PRECISION):
+    '''
+    Build the {grid_id: distance} dict for grid points closer than d_cutoff
+    '''
+    close = np.flatnonzero(d < d_cutoff)
+    return {int(ids[i]): round(float(d[i]), precision) for i in close}
+
+
+def station_neighbors(grid_arrays, latitude, longitude):
+    '''
+    Return all grid points closer than 30 miles to the given station
+
+    Returns
+    -------
+    dict
+                Keys are grid ids, values are distances rounded to 0.1 mile
+    '''
+    index = grid_arrays.candidates([latitude], [longitude])[0]
+    d = grid_arrays.distances(latitude, longitude, index)
+    return neighbors_from_distances(grid_arrays.ids[index], d)
+
+
+def block_station_neighbors(grid_arrays, stations, block_size=1024):
+    '''
+    Compute neighbor dicts for many stations, a block of stations at a time
+
+    Parameters
+    ----------
+    grid_arrays : GridArrays
+                Grid to search
+    stations : list
+                Tuples (station_id, latitude, longitude)
+    block_size : int
+                Number of stations per KD-tree query
+
+    Returns
+    -------
+    list
+                Tuples (station_id, {grid_id: distance})
+    '''
+    result = []
+    for start in range(0, len(stations), block_size):
+        block = stations[start:start + block_size]
+        found = grid_arrays.candidates([s[1] for s in block],
+                                       [s[2] for s in block])
+        for station, index in zip(block, found):
+            d = grid_arrays.distances(station[1], station[2], index)
+            result.append((station[0],
+                           neighbors_from_distances(grid_arrays.ids[index], d)))
+    return result
+
+
+def compare_with_scalar(grid, stations):
+    '''
+    Check the vectorized engine against compile_stations.calc_distance
+    and report the time taken by both
+
+    Parameters
+    ----------
+    grid : list
+                Grid points as loaded from grid.json
+    stations : list
+                Tuples (station_id, latitude, longitude)
+
+    Returns
+    -------
+    int
+                Number of stations whose neighbor dicts differ
+    '''
+    import compile_stations
+
+    compile_stations.GRID = grid
+    start = time.time()
+    scalar = [compile_stations.determine_grid_point_neighbors(station)
+              for station in stations]
+    scalar_time = time.time() - start
+
+    grid_arrays = GridArrays(grid)
+    start = time.time()
+    vectorized = block_station_neighbors(grid_arrays, stations)
+    vectorized_time = time.time() - start
+
+    mismatches = 0
+    for (station_id, expected), (_, found) in zip(scalar, vectorized):
+        if expected != found:
+            mismatches += 1
+            print('Mismatch for station {}'.format(station_id))
+
+    print('Stations: {}, grid points: {}'.format(len(stations), len(grid)))
+    print('Scalar: {:.2f} s, vectorized: {:.2f} s, speedup: {:.0f}x'.format(
+        scalar_time, vectorized_time, scalar_time / max(vectorized_time, 1e-9)))
+    print('Mismatching stations: {}'.format(mismatches))
+    return mismatches
+
+
+if __name__ == '__main__':
+    # Usage: python grid_neighbors.py grid.json aqs_sites.csv [n_stations]
+    from compile_stations import parse_station_record
+
+    with open(sys.argv[1], 'r') as f:
+        GRID = json.loads(f.readline())
+
+    n_stations = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    STATIONS = []
+    with open(sys.argv[2], 'r') as f:
+        for line in f:
+            station = parse_station_record(line)
+            if station is not None:
+                STATIONS.append(station)
+            if len(STATIONS) >= n_stations:
+                break
+
+    sys.exit(1 if compare_with_scalar(GRID, STATIONS) else 0)
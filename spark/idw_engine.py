@@ -0,0 +1,140 @@
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+def weight_matrix(table):
+    '''
+    Station to grid inverse distance weight matrix
+
+    The station table is already in CSR layout, so the matrix shares its
+    offsets, grid ids and weights: row i holds the 1/d^2 weights of the
+    grid points within 30 miles of station i, column j is grid id j. It is
+    built once per table and kept on it as table.matrix.
+
+    Parameters
+    ----------
+    table : StationTable
+                Station to grid neighbor table
+
+    Returns
+    -------
+    csr_matrix
+                Matrix of shape (len(table), max grid id + 1)
+    '''
+    if table.matrix is None:
+        n_grid = int(table.grid_ids.max()) + 1 if len(table.grid_ids) else 0
+        table.matrix = csr_matrix((table.weights, table.grid_ids, table.offsets),
+                                  shape=(len(table), n_grid))
+    return table.matrix
+
+
+def interpolate(table, readings):
+    '''
+    Inverse distance weighted grid values for one (timestamp, parameter)
+
+    Readings of the same station are summed and counted, so the numerator
+    and denominator are exactly those of the flatMap/reduceByKey fan-out:
+    sum(w*C) and sum(w) over every reading within 30 miles. Stations
+    without a reading are masked out by only taking their matrix rows.
+
+    Parameters
+    ----------
+    table : StationTable
+                Station to grid neighbor table
+    readings : iterable
+                Tuples (site_id, C); unknown station IDs are skipped
+
+    Returns
+    -------
+    tuple
+                Arrays (grid_ids, values) for grid points with data
+    '''
+    positions = []
+    values = []
+    for site_id, C in readings:
+        i = table.site_index.get(site_id)
+        if i is not None:
+            positions.append(i)
+            values.append(C)
+    if not positions:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    rows, inverse = np.unique(positions, return_inverse=True)
+    C_sum = np.bincount(inverse, weights=values)
+    count = np.bincount(inverse).astype(np.float64)
+
+    weights = weight_matrix(table)[rows].T
+    numerator = weights.dot(C_sum)
+    denominator = weights.dot(count)
+    grid_ids = np.flatnonzero(denominator)
+    return grid_ids, numerator[grid_ids] / denominator[grid_ids]
+
+
+def interpolate_hour(group, table):
+    '''
+    Spark flatMap over ((timestamp, parameter), [(site_id, C), ...]) groups
+
+    Returns
+    -------
+    list
+                Tuples (grid_id, parameter, timestamp, C), the same records
+                as calc_weighted_average_grid in raw_batch.py
+    '''
+    (timestamp, parameter), readings = group
+    grid_ids, values = interpolate(table, readings)
+    return [(grid_id, parameter, timestamp, C)
+            for grid_id, C in zip(grid_ids.tolist(), values.tolist())]
+
+
+def interpolate_frame(frame, table):
+    '''
+    Spark applyInPandas over the readings of one (time, parameter) group
+
+    Parameters
+    ----------
+    frame : pandas.DataFrame
+                Columns site_id, parameter, c, time
+    table : StationTable
+                Station to grid neighbor table
+
+    Returns
+    -------
+    pandas.DataFrame
+                Columns grid_id, parameter, time, c, see raw_batch.hourly_schema
+    '''
+    grid_ids, values = interpolate(table, zip(frame['site_id'], frame['c']))
+    return pd.DataFrame({
+        'grid_id': grid_ids.astype(np.int32),
+        'parameter': np.full(len(grid_ids), frame['parameter'].iloc[0], dtype=np.int32),
+        'time': np.repeat(frame['time'].iloc[0], len(grid_ids)),
+        'c': values.astype(np.float32),
+    })
+
+
+def interpolate_readings(table, readings):
+    '''
+    Standalone equivalent of the Spark pipeline for in-memory readings
+
+    Parameters
+    ----------
+    table : StationTable
+                Station to grid neighbor table
+    readings : iterable
+                Tuples (site_id, parameter, C, timestamp) as returned by
+                raw_batch.parse_measurement_record
+
+    Returns
+    -------
+    list
+                Tuples (grid_id, parameter, timestamp, C)
+    '''
+    groups = defaultdict(list)
+    for site_id, parameter, C, timestamp in readings:
+        groups[(timestamp, parameter)].append((site_id, C))
+    result = []
+    for key in sorted(groups):
+        result.extend(interpolate_hour((key, groups[key]), table))
+    return result
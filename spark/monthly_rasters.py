@@ -0,0 +1,156 @@
+import io
+import os
+
+import numpy as np
+
+
+def lattice_positions(raster):
+    '''
+    Flat lattice index of every grid id of a grid_index.npz raster
+
+    Returns
+    -------
+    numpy.ndarray
+                positions[grid_id] is the index of the grid point in
+                raster.ravel(), -1 for ids not on the lattice
+    '''
+    flat = np.flatnonzero(raster)
+    positions = np.full(int(raster.max()) + 1, -1, dtype=np.int64)
+    positions[raster.ravel()[flat]] = flat
+    return positions
+
+
+def load_lattice(fname):
+    '''
+    Grid id positions and lattice shape from the index written by
+    generate_uniform_grid.py
+    '''
+    with np.load(fname) as f:
+        raster = f['raster']
+    return lattice_positions(raster), raster.shape
+
+
+def raster_key(parameter, month):
+    '''
+    Relative path of the raster of a weather code and month,
+    e.g. '62101/2021-07.npy'
+    '''
+    return '{}/{:%Y-%m}.npy'.format(parameter, month)
+
+
+def month_raster(values, positions, shape, dtype=np.float32):
+    '''
+    Raster of one month and parameter over the lattice, NaN where there
+    is no value
+
+    Parameters
+    ----------
+    values : iterable
+                (grid_id, C) pairs
+    positions : numpy.ndarray
+                See lattice_positions
+    shape : tuple
+                (N_lat, N_lon), row 0 is the southernmost lattice row
+    '''
+    pairs = np.array(list(values), dtype=np.float64).reshape(-1, 2)
+    grid_ids = pairs[:, 0].astype(np.int64)
+    known = grid_ids < len(positions)
+    index = np.where(known, positions[np.where(known, grid_ids, 0)], -1)
+    on_lattice = index >= 0
+    raster = np.full(shape[0] * shape[1], np.nan, dtype=dtype)
+    raster[index[on_lattice]] = pairs[on_lattice, 1]
+    return raster.reshape(shape)
+
+
+def is_s3(location):
+    return location.startswith('s3://') or location.startswith('s3a://')
+
+
+def npy_bytes(raster):
+    '''
+    A raster serialized in .npy format
+    '''
+    buffer = io.BytesIO()
+    np.save(buffer, raster, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def save_npy(data, location, key):
+    '''
+    Save a serialized raster under a local directory or an
+    s3://bucket/prefix location
+
+    Local files are written to a temporary name and renamed, so readers
+    never see a partial raster
+    '''
+    if is_s3(location):
+        import boto3
+
+        bucketname, _, prefix = location.split('://', 1)[1].partition('/')
+        boto3.client('s3').put_object(
+            Bucket=bucketname, Key=prefix.rstrip('/') + '/' + key,
+            Body=data, ContentType='application/octet-stream')
+        return
+
+    fname = os.path.join(location, key)
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_fname, fname)
+
+
+def frame_raster(frame, lattice, dtype):
+    '''
+    Raster key and raster of the monthly values of one (time, parameter)
+    group, see month_raster
+    '''
+    positions, shape = lattice
+    month = frame['time'].iloc[0]
+    parameter = int(frame['parameter'].iloc[0])
+    raster = month_raster(zip(frame['grid_id'], frame['c']), positions, shape,
+                          np.dtype(dtype))
+    return raster_key(parameter, month), raster
+
+
+def write_raster_frame(frame, lattice, location, dtype='float32'):
+    '''
+    Spark applyInPandas over the monthly values of one (time, parameter)
+    group: write its raster to an s3://bucket/prefix location shared by
+    all executors
+
+    Parameters
+    ----------
+    frame : pandas.DataFrame
+                Columns grid_id, time, parameter, c
+    lattice : tuple
+                (positions, shape), see load_lattice
+
+    Returns
+    -------
+    pandas.DataFrame
+                Column rasters with the number of rasters written
+    '''
+    import pandas as pd
+
+    key, raster = frame_raster(frame, lattice, dtype)
+    save_npy(npy_bytes(raster), location, key)
+    return pd.DataFrame({'rasters': [1]})
+
+
+def serialize_raster_frame(frame, lattice, dtype='float32'):
+    '''
+    Spark applyInPandas like write_raster_frame, returning the raster to
+    the driver instead of writing it, for locations executors cannot
+    reach (e.g. a directory on the web server)
+
+    Returns
+    -------
+    pandas.DataFrame
+                Columns key and npy (the raster in .npy format)
+    '''
+    import pandas as pd
+
+    key, raster = frame_raster(frame, lattice, dtype)
+    return pd.DataFrame({'key': [key], 'npy': [npy_bytes(raster)]})
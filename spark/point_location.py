@@ -1,4 +1,6 @@
+import numpy as np
 from shapely.geometry import MultiPoint, Point, Polygon
+from shapely.vectorized import contains
 import shapefile
 #return a polygon for each state in a dictionary
 def get_us_border_polygon():
@@ -27,3 +29,37 @@ def in_us(lat, lon):
             return state
     return None
 
+
+#state of each point for a whole array of points at once
+def states_for_points(lat, lon):
+    '''
+    Vectorized in_us: return the state of every point, None if outside
+
+    Each state polygon is only tested against the points inside its
+    bounding box, and those are tested in bulk with prepared geometry.
+    States are visited in the same order as in_us, so a point on a shared
+    border gets the same state as in_us would return.
+
+    Parameters
+    ----------
+    lat, lon : array_like
+                Coordinates of the points in degrees
+
+    Returns
+    -------
+    ndarray
+                Object array of state codes, None outside the U.S.
+    '''
+    lat = np.asarray(lat, dtype=np.float64).ravel()
+    lon = np.asarray(lon, dtype=np.float64).ravel()
+    states = np.full(lat.shape, None, dtype=object)
+    for state, poly in state_polygons.items():
+        minx, miny, maxx, maxy = poly.bounds
+        candidates = np.flatnonzero((states == None) &
+                                    (lon >= minx) & (lon <= maxx) &
+                                    (lat >= miny) & (lat <= maxy))
+        if len(candidates) == 0:
+            continue
+        inside = contains(poly, lon[candidates], lat[candidates])
+        states[candidates[inside]] = state
+    return states
@@ -1,8 +1,12 @@
 from __future__ import print_function
 
+import os
 import sys
 import csv
+import time
 import json
+import pickle
+import argparse
 import boto3
 from datetime import datetime
 from io import StringIO
@@ -12,8 +16,27 @@ import configparser
 from pyspark import SparkContext, SparkConf
 from pyspark.storagelevel import StorageLevel
 from pyspark.sql import SparkSession, SQLContext
+from pyspark.sql import functions as F
 from pyspark.sql.types import (StructType, StructField, FloatType,
-                               TimestampType, IntegerType)
+                               TimestampType, IntegerType, StringType,
+                               DoubleType)
+
+import station_table
+import idw_engine
+import cassandra_sink
+import monthly_rasters
+
+# PostgreSQL bulk loader, shared with the scripts in ../postgres
+sys.path.append('../postgres')
+import bulk_load
+
+
+# Weather parameter codes carried together by the fused engine,
+# the same codes app.py reads back
+PARAMETERS = (64101,  # pressure
+              61103,  # wind
+              62101,  # temperature
+              62201)  # humidity
 
 
 def file_year(fname):
@@ -105,7 +128,7 @@ def convert_to_float(string):
     except ValueError:
         return None
 
-def parse_measurement_record(measurement_record):
+def parse_measurement_record(measurement_record, stations):
     '''
     This function ...
 
@@ -113,6 +136,8 @@ def parse_measurement_record(measurement_record):
     -----
     line : str
                 One line containing air monitor reading
+    stations : StationTable
+                Station to grid neighbor table
 
     Returns
     -------
@@ -138,8 +163,7 @@ def parse_measurement_record(measurement_record):
     site_id = '|'.join([state_id, county_id, site_number])
 
     # Check if this is in the station lookup table to avoid issues downstream
-    grid = STATIONS.get(site_id, None)
-    if not grid:
+    if site_id not in stations:
         return None
 
     # Carve out the GMT timestamp
@@ -163,7 +187,208 @@ def parse_measurement_record(measurement_record):
     return (site_id, parameter, C, timestamp)
 
 
-def station_to_grid(rdd):
+# Schema of the EPA hourly files, see measurement_schema
+# Dates and times are kept as strings and combined into a GMT timestamp
+measurement_schema = StructType([
+    StructField("state_code", StringType(), True),
+    StructField("county_code", StringType(), True),
+    StructField("site_num", StringType(), True),
+    StructField("parameter", IntegerType(), True),
+    StructField("poc", IntegerType(), True),
+    StructField("latitude", DoubleType(), True),
+    StructField("longitude", DoubleType(), True),
+    StructField("datum", StringType(), True),
+    StructField("parameter_name", StringType(), True),
+    StructField("date_local", StringType(), True),
+    StructField("time_local", StringType(), True),
+    StructField("date_gmt", StringType(), True),
+    StructField("time_gmt", StringType(), True),
+    StructField("c", DoubleType(), True),
+    StructField("units", StringType(), True),
+    StructField("mdl", DoubleType(), True),
+    StructField("uncertainty", StringType(), True),
+    StructField("qualifier", StringType(), True),
+    StructField("method_type", StringType(), True),
+    StructField("method_code", StringType(), True),
+    StructField("method_name", StringType(), True),
+    StructField("state_name", StringType(), True),
+    StructField("county_name", StringType(), True),
+    StructField("date_of_last_change", StringType(), True),
+])
+
+# Hourly grid values, as produced by every engine
+hourly_schema = StructType([
+    StructField("grid_id", IntegerType(), False),
+    StructField("parameter", IntegerType(), False),
+    StructField("time", TimestampType(), False),
+    StructField("c", FloatType(), False)
+])
+
+
+def read_measurements_df(spark, path, site_ids):
+    '''
+    Columnar equivalent of parse_measurement_record
+
+    The EPA file is read with an explicit schema and every filter and
+    conversion of parse_measurement_record runs as a JVM column
+    expression, so no Python worker touches the raw lines.
+
+    Parameters
+    ----------
+    spark : SparkSession
+                Spark session
+    path : str
+                Path of the EPA hourly file(s)
+    site_ids : list
+                Station IDs present in the station table
+
+    Returns
+    -------
+    DataFrame
+                Columns site_id, parameter, c, time -- the same fields
+                (and order) as the tuples of parse_measurement_record
+    '''
+    stations_df = spark.createDataFrame([(str(s),) for s in site_ids], ['site_id'])
+
+    df = spark.read.csv(path, schema=measurement_schema, header=True)
+    return df\
+        .filter(~F.col("state_code").isin('State Code', 'CC', '80', '78', '66'))\
+        .withColumn("site_id", F.concat_ws('|', "state_code", "county_code", "site_num"))\
+        .join(F.broadcast(stations_df), on="site_id", how="inner")\
+        .filter((F.col("c") != 0.) & (F.col("mdl") != 0.) & (F.col("c") >= 0.))\
+        .withColumn("c", F.when(F.col("c") < F.col("mdl"), F.lit(0.))
+                    .otherwise(F.col("c")))\
+        .withColumn("time", F.to_timestamp(F.concat("date_gmt", "time_gmt"),
+                                           'yyyy-MM-ddHH:mm'))\
+        .filter(F.col("time").isNotNull())\
+        .select("site_id", "parameter", "c", "time")
+
+
+def dedup_station_hours_df(measurements, how):
+    '''
+    Columnar equivalent of dedup_station_hours, run in the JVM
+
+    The result is persisted: it is counted once for the duplicate counters
+    and then gridded
+
+    Returns
+    -------
+    tuple
+                (DataFrame with columns site_id, parameter, c, time, one row
+                per station-hour; readings in; readings out)
+    '''
+    combine = F.avg("c") if how == 'mean' else F.first("c")
+    deduped = measurements\
+        .groupBy("site_id", "parameter", "time")\
+        .agg(combine.alias("c"), F.count(F.lit(1)).alias("readings"))\
+        .persist(StorageLevel.MEMORY_AND_DISK)
+    records_in, records_out = deduped\
+        .agg(F.sum("readings"), F.count(F.lit(1)))\
+        .first()
+    return (deduped.select("site_id", "parameter", "c", "time"),
+            records_in or 0, records_out)
+
+
+def grid_hourly_df(measurements, stations):
+    '''
+    Sparse IDW gridding of a measurements DataFrame
+
+    Readings are grouped by (time, parameter) in the JVM and every group
+    reaches Python as an Arrow batch, see idw_engine.interpolate_frame
+
+    Parameters
+    ----------
+    measurements : DataFrame
+                Columns site_id, parameter, c, time
+    stations : Broadcast
+                Station table, see broadcast_stations
+
+    Returns
+    -------
+    DataFrame
+                Columns of hourly_schema
+    '''
+    return measurements\
+        .groupBy("time", "parameter")\
+        .applyInPandas(lambda frame: idw_engine.interpolate_frame(
+            frame, station_table.resolve(stations.value)), schema=hourly_schema)
+
+
+def monthly_average_df(hourly):
+    '''
+    Average of the hourly grid values over every calendar month
+
+    Returns
+    -------
+    DataFrame
+                Columns grid_id, time (first of the month), parameter, c
+    '''
+    return hourly\
+        .groupBy("grid_id", F.date_trunc("month", "time").alias("time"), "parameter")\
+        .agg(F.avg("c").cast(FloatType()).alias("c"))\
+        .select("grid_id", "time", "parameter", "c")
+
+
+def frame_rows(frames, columns):
+    '''
+    Rows of the pandas batches of a mapInPandas function as tuples of
+    Python values, with the given columns in order
+    '''
+    for frame in frames:
+        for row in frame[columns].itertuples(index=False, name=None):
+            yield row
+
+
+def combine_readings(val1, val2, how):
+    '''
+    Combine two (C, count) readings of the same station, parameter and hour
+
+    'mean' sums values and counts so the final value is their average,
+    'first' keeps whichever reading Spark combines first
+    '''
+    if how == 'first':
+        return val1
+    return (val1[0] + val2[0], val1[1] + val2[1])
+
+
+def dedup_station_hours(measurements, how, records_in, records_out):
+    '''
+    Collapse readings to one value per (site_id, parameter, hour)
+
+    Sites often report several monitors (POCs) for the same hour; without
+    this step each of them is fanned out to every neighbor grid point.
+
+    Parameters
+    ----------
+    measurements : RDD
+                Tuples (site_id, parameter, C, timestamp)
+    how : str
+                'mean' or 'first'
+    records_in, records_out : Accumulator
+                Counters of readings before and after deduplication
+
+    Returns
+    -------
+    RDD
+                Tuples (site_id, parameter, C, timestamp), one per station-hour
+    '''
+    def count_in(rdd):
+        records_in.add(1)
+        return ((rdd[0], rdd[1], rdd[3]), (rdd[2], 1))
+
+    def average(rdd):
+        records_out.add(1)
+        site_id, parameter, timestamp = rdd[0]
+        C, count = rdd[1]
+        return (site_id, parameter, C / float(count), timestamp)
+
+    return measurements\
+        .map(count_in)\
+        .reduceByKey(lambda val1, val2: combine_readings(val1, val2, how))\
+        .map(average)
+
+
+def station_to_grid(rdd, stations):
     '''
     Takes RDD with air quality stations' readings and and returns
     RDDs for readings transformed to nearest grid points
@@ -172,6 +397,8 @@ def station_to_grid(rdd):
     ----------
     rdd : RDD
                 RDD of air monitors readings
+    stations : StationTable
+                Station to grid neighbor table
 
     Returns
     -------
@@ -182,24 +409,96 @@ def station_to_grid(rdd):
     parameter = rdd[1]
     C = rdd[2]
     timestamp = rdd[3]
-    # Since we made sure upstream that site_id is in dictionary, can extract it
-    # STATIONS is a dictionary -- keys are station IDs (e.g. '41|031|1002') and values are dicts
-    # Format of sub-dicts: keys are grid points, values are distances
-    grid = STATIONS[site_id]
+    # Since we made sure upstream that site_id is in the table, can extract it
+    # stations is a StationTable -- keyed by station IDs (e.g. '41|031|1002')
+    # Neighbors are grid ids within 30 miles with precomputed 1/d^2 weights
+    grid_ids, weights = stations.neighbors(site_id)
     measurements = []
     # For each grid point within 30 miles of the station,
     # add a tuple-tuple in the form (grid_id, timestamp, [pollutant]), (concentration, weight)
-    # The for loop iterates over the keys
-    for grid_id in grid:
-        distance = grid[grid_id]
-        weight = 1. / (distance ** 2)
+    for grid_id, weight in zip(grid_ids.tolist(), weights.tolist()):
         # C is the pollutant concentration
         weight_C_prod = C * weight
-        measurements.append(((int(grid_id), timestamp, parameter),
+        measurements.append(((grid_id, timestamp, parameter),
                             (weight_C_prod, weight)))
     return measurements
 
 
+def station_hour_vector(rdd):
+    '''
+    Key a reading by station and hour, with a vector of per-parameter sums
+
+    The vector holds (sum C, number of readings) for every code in
+    PARAMETERS, with only the slot of this reading's parameter filled
+
+    Returns
+    -------
+    tuple
+                ((site_id, timestamp), [C_1, n_1, C_2, n_2, ...]), or None
+                if the parameter is not one of PARAMETERS
+    '''
+    site_id = rdd[0]
+    parameter = rdd[1]
+    C = rdd[2]
+    timestamp = rdd[3]
+    if parameter not in PARAMETERS:
+        return None
+    vector = [0.] * (2 * len(PARAMETERS))
+    slot = 2 * PARAMETERS.index(parameter)
+    vector[slot] = C
+    vector[slot + 1] = 1.
+    return ((site_id, timestamp), vector)
+
+
+def add_vectors(val1, val2):
+    '''
+    Element-wise sum of two fixed-size vectors
+    '''
+    return [x + y for x, y in zip(val1, val2)]
+
+
+def station_vector_to_grid(rdd, stations):
+    '''
+    Fused station_to_grid: fan a station-hour vector out to the grid once
+    for all parameters
+
+    Returns
+    -------
+    list
+                Tuples ((grid_id, timestamp), [w*C_1, w*n_1, ...]); reduced
+                with add_vectors these are sum(w*C) and sum(w) per parameter
+    '''
+    site_id, timestamp = rdd[0]
+    vector = rdd[1]
+    grid_ids, weights = stations.neighbors(site_id)
+    measurements = []
+    for grid_id, weight in zip(grid_ids.tolist(), weights.tolist()):
+        measurements.append(((grid_id, timestamp),
+                             [weight * x for x in vector]))
+    return measurements
+
+
+def unpack_grid_vector(rdd):
+    '''
+    Weighted averages for every parameter present in a grid-hour vector
+
+    Returns
+    -------
+    list
+                Tuples (grid_id, parameter, timestamp, C), the same records
+                as calc_weighted_average_grid
+    '''
+    grid_id, timestamp = rdd[0]
+    vector = rdd[1]
+    records = []
+    for i, parameter in enumerate(PARAMETERS):
+        weight = vector[2 * i + 1]
+        if weight > 0.:
+            records.append((grid_id, parameter, timestamp,
+                            vector[2 * i] / weight))
+    return records
+
+
 def sum_weight_and_prods(val1, val2):
     '''
     Little custom map function to compute weighted averages
@@ -240,30 +539,168 @@ def calc_weighted_average_grid(rdd):
     return (grid_id, parameter, timestamp, weighted_avg)
 
 
-def group_by_month(rdd):
+def write_hourly_to_cassandra(data_hourly, args, username, password):
     '''
-    Given an rdd containing weighted average air pollution level at grid point,
-    determine the month and year for it, and prepare for averaging
+    Write hourly grid values to Cassandra with cassandra_sink.write_hourly
+
+    Records are hash-partitioned into --cassandra-partitions Spark
+    partitions on the table's full Cassandra partition key and sorted by
+    that key and time within each of them, so every Cassandra partition is
+    written by one task, in time order, in as few batches as possible.
+    Rows reach the Python writers as Arrow batches through mapInPandas and
+    are written as they stream in.
+
+    Parameters
+    ----------
+    data_hourly : DataFrame
+                Columns of hourly_schema
+    args : Namespace
+                Command line arguments with the --cassandra-* options
+    username, password : str
+                Cassandra credentials
     '''
-    grid_id = rdd[0]
-    parameter = rdd[1]
-    timestamp = rdd[2]
-    C = rdd[3]
-    month_year = datetime.strftime(timestamp, '%m%Y')
-    return ((grid_id, month_year, parameter), (C, 1))
+    import pandas as pd
+
+    contact_points = args.cassandra_hosts.split(',') if args.cassandra_hosts else None
+    concurrency = args.cassandra_concurrency
+    batch_rows = args.cassandra_batch_rows
+    table = args.cassandra_table
+
+    def write_partition(frames):
+        from pyspark import SparkFiles
+
+        bundle = None if contact_points else\
+            SparkFiles.get('secure-connect-epa-weather-history.zip')
+        session = cassandra_sink.connect(contact_points, secure_bundle=bundle,
+                                         username=username, password=password)
+        stats = cassandra_sink.write_hourly(
+            session, frame_rows(frames, ['grid_id', 'parameter', 'time', 'c']),
+            max_batch_rows=batch_rows, concurrency=concurrency, table=table)
+        yield pd.DataFrame({'rows': [stats.rows], 'batches': [stats.batches],
+                            'retries': [stats.retries], 'failures': [stats.failures],
+                            'seconds': [stats.seconds]})
+
+    partition_columns = cassandra_sink.PARTITION_COLUMNS[table]
+    totals = data_hourly\
+        .withColumn("year", F.year("time"))\
+        .repartition(args.cassandra_partitions, *partition_columns)\
+        .sortWithinPartitions(*(partition_columns + ("time",)))\
+        .mapInPandas(write_partition, 'rows long, batches long, retries long, '
+                                      'failures long, seconds double')\
+        .agg(*[F.sum(name).alias(name) for name in
+               ('rows', 'batches', 'retries', 'failures', 'seconds')])\
+        .first()
+
+    print('Cassandra hourly sink: {} rows in {} batches, {} retries, {} failed '
+          'batches, {:.0f} rows/s per task'.format(
+              totals.rows, totals.batches, totals.retries, totals.failures,
+              totals.rows / totals.seconds if totals.seconds else 0.))
+
+
+def broadcast_stations(sc, location, lazy=False):
+    '''
+    Broadcast the station table to the executors
 
+    Parameters
+    ----------
+    sc : SparkContext
+                Spark context
+    location : str
+                Local directory or s3://bucket/prefix of the station table
+    lazy : bool
+                If True, broadcast only the location and let every executor
+                load (and memory-map) the table itself on first use
 
-def average_over_month(rdd):
+    Returns
+    -------
+    Broadcast
+                Broadcast variable to pass to station_table.resolve
     '''
-    Given rdd containing sum of air pollution level at grid point over month,
-    compute the average pollution in a month for a given compound
+    if lazy:
+        value = location
+    else:
+        value = station_table.load_location(location, 'stations_csr')
+        print('Station table: {} stations, {} neighbors, {} bytes of arrays'
+              .format(len(value), len(value.grid_ids), value.nbytes))
+    size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    print('Broadcasting station table ({}): {:.1f} MB'.format(
+        'lazy' if lazy else 'eager', size / 1e6))
+    return sc.broadcast(value)
+
+
+def parse_args(argv):
     '''
-    grid_id = rdd[0][0]
-    month_year = rdd[0][1]
-    timestamp = datetime.strptime(month_year, '%m%Y')
-    parameter = rdd[0][2]
-    C = rdd[1][0] / float(rdd[1][1])
-    return (grid_id, timestamp, parameter, C)
+    Parse command line arguments of the batch job
+    '''
+    parser = argparse.ArgumentParser(description='Grid hourly EPA measurements')
+    parser.add_argument('data_files', nargs='+',
+                        help='EPA hourly file(s) in the S3 bucket, e.g. one '
+                             'per weather parameter for the fused engine')
+    parser.add_argument('--stations', default=None,
+                        help='Station table location (default: '
+                             's3://<bucket>/emr-data/stations_csr)')
+    parser.add_argument('--stations-lazy', action='store_true',
+                        help='Load the station table on the executors '
+                             'instead of broadcasting it from the driver')
+    parser.add_argument('--ingest', choices=['rdd', 'dataframe'], default='rdd',
+                        help='Parse EPA lines in Python (rdd) or with '
+                             'spark.read.csv column expressions (dataframe); '
+                             'dataframe always grids with the sparse engine, '
+                             'fed Arrow batches through applyInPandas')
+    parser.add_argument('--engine', choices=['fanout', 'sparse', 'fused'],
+                        default=None,
+                        help='Grid readings by station x neighbor fan-out and '
+                             'reduceByKey, by sparse matrix products over '
+                             '(timestamp, parameter) groups, or by one fan-out '
+                             'per station-hour for all PARAMETERS (fused); '
+                             'default fanout, and only sparse with '
+                             '--ingest dataframe')
+    parser.add_argument('--dedup', choices=['none', 'mean', 'first'], default='none',
+                        help='Collapse duplicate readings of a station, '
+                             'parameter and hour before gridding')
+    parser.add_argument('--monthly-writer', choices=['jdbc', 'copy'], default='jdbc',
+                        help='Write monthly averages with JDBC row inserts or '
+                             'with COPY into a staging table per partition')
+    parser.add_argument('--copy-batch-size', type=int, default=50000,
+                        help='Rows per COPY statement for --monthly-writer copy')
+    parser.add_argument('--copy-parallelism', type=int, default=8,
+                        help='Concurrent COPY connections (Spark partitions) '
+                             'for --monthly-writer copy')
+    parser.add_argument('--hourly-sink', choices=['none', 'cassandra'], default='none',
+                        help='Write hourly grid values to Cassandra, into '
+                             '--cassandra-table')
+    parser.add_argument('--cassandra-hosts', default=None,
+                        help='Comma-separated contact points of a self-managed '
+                             'Cassandra (e.g. 127.0.0.1) instead of the Astra bundle')
+    parser.add_argument('--cassandra-concurrency', type=int, default=16,
+                        help='Batches in flight per Spark partition')
+    parser.add_argument('--cassandra-partitions', type=int, default=64,
+                        help='Spark partitions (writer tasks) of the hourly sink')
+    parser.add_argument('--cassandra-batch-rows', type=int, default=100,
+                        help='Rows per unlogged single-partition batch')
+    parser.add_argument('--cassandra-table', default='table_hourly_by_year',
+                        choices=sorted(cassandra_sink.HOURLY_TABLES),
+                        help='Hourly table; table_hourly_by_year buckets each '
+                             'grid point history by year')
+    parser.add_argument('--rasters', default=None,
+                        help='Also write one raster per month and parameter '
+                             'over the grid lattice, for map overlays: to '
+                             's3://bucket/prefix from the executors, or to '
+                             'a directory on the driver')
+    parser.add_argument('--raster-dtype', choices=['float32', 'float16'],
+                        default='float32',
+                        help='Value type of the rasters')
+    parser.add_argument('--grid-index', default='grid_index.npz',
+                        help='Lattice index written by generate_uniform_grid.py')
+    args = parser.parse_args(argv)
+    if args.ingest == 'dataframe':
+        if args.engine not in (None, 'sparse'):
+            parser.error('--ingest dataframe grids with the sparse engine, '
+                         'not --engine {}'.format(args.engine))
+        args.engine = 'sparse'
+    elif args.engine is None:
+        args.engine = 'fanout'
+    return args
 
 
 def main(argv):
@@ -292,24 +729,32 @@ def main(argv):
         'password': config["postgres"]["password"],
         'driver': 'org.postgresql.Driver'
     }
+    postgres_dsn = {
+        'host': config["postgres"]["host"],
+        'dbname': config["postgres"]["database"],
+        'user': config["postgres"]["user"],
+        'password': config["postgres"]["password"]
+    }
     cassandra_url = config["cassandra"]["dns"]
     cassandra_username = config["cassandra"]["user"]
     cassandra_password = config["cassandra"]["password"]
     s3_access_key = config["s3"]["aws_access_key_id"]
     s3_secret_key = config["s3"]["aws_secret_access_key"]
 
-    # Global variable STATIONS to store distances from stations to grid points
-
-    global STATIONS
-    STATIONS = get_grid_from_file(bucket_name, "emr-data/stations.json")
-
     # Start processing data files
 
-    if len(argv) < 1:
-        raise AssertionError("Usage: raw_batch.sh <data_file>")
+    # EPA times are GMT. Spark SQL and the Python workers (which turn
+    # timestamps into naive datetimes) both run in UTC, so no hour is
+    # shifted by a DST gap or overlap between the JVM and Python
+    os.environ['TZ'] = 'UTC'
+    time.tzset()
 
-    data_fname = argv[0]
-    print('Processing file {}\n'.format(data_fname))
+    args = parse_args(argv)
+    stations_location = args.stations or\
+        's3://' + bucket_name + '/emr-data/stations_csr'
+
+    data_fnames = args.data_files
+    print('Processing files {}\n'.format(', '.join(data_fnames)))
 
     # Create Spark context & session
 
@@ -321,94 +766,166 @@ def main(argv):
                       .set("spark.cassandra.auth.password", cassandra_password)\
                       .set("spark.jars.packages", "org.apache.hadoop:hadoop-aws:3.2.0,com.datastax.spark:spark-cassandra-connector_2.12:3.1.0")\
                       .set("spark.hadoop.fs.s3a.impl", "org.apache.hadoop.fs.s3a.S3AFileSystem")\
-                      .set("spark.sql.extensions", "com.datastax.spark.connector.CassandraSparkExtensions")
+                      .set("spark.sql.extensions", "com.datastax.spark.connector.CassandraSparkExtensions")\
+                      .set("spark.sql.session.timeZone", "UTC")\
+                      .set("spark.executorEnv.TZ", "UTC")
 
     sc = SparkContext(conf=conf)
+    sc.addPyFile('station_table.py')
+    sc.addPyFile('idw_engine.py')
+    sc.addPyFile('cassandra_sink.py')
+    sc.addPyFile('monthly_rasters.py')
+    sc.addPyFile('../postgres/bulk_load.py')
     spark = SparkSession(sc)
     sqlContext = SQLContext(sc)
 
-    # Schemas for converting RDDs to DataFrames & writing to DBs
-
-    schema_hourly = StructType([
-        StructField("grid_id", IntegerType(), False),
-        StructField("parameter", IntegerType(), False),
-        StructField("time", TimestampType(), False),
-        StructField("c", FloatType(), False)
-    ])
-
-    schema_monthly = StructType([
-        StructField("grid_id", IntegerType(), False),
-        StructField("time", TimestampType(), False),
-        StructField("parameter", IntegerType(), False),
-        StructField("c", FloatType(), False)
-    ])
-
-    raw = s3 + data_fname
-    data_rdd = sc.textFile(raw)
-    print(data_rdd.count())
-
-    # Compute hourly pollution levels on the grid
-    # .filter(lambda line: line is not None)\
-    # .flatMap(station_to_grid)\
-    # .reduceByKey(sum_weight_and_prods)\
-    # .map(calc_weighted_average_grid)\
-    # .persist(StorageLevel.MEMORY_AND_DISK)
-    data_hourly = data_rdd\
-        .map(parse_measurement_record)\
-        .filter(lambda line: line is not None)\
-        .flatMap(station_to_grid)\
-        .reduceByKey(sum_weight_and_prods)\
-        .map(calc_weighted_average_grid)\
-        .persist(StorageLevel.MEMORY_AND_DISK)
-
+    # Distances from stations to grid points, shipped once per executor
+    stations = broadcast_stations(sc, stations_location, args.stations_lazy)
+
+    raw = [s3 + data_fname for data_fname in data_fnames]
+    if args.ingest == 'dataframe':
+        # Parsed, deduplicated and grouped by hour in the JVM; Python only
+        # sees Arrow batches of each (hour, parameter) group for the
+        # sparse IDW step
+        site_ids = station_table.resolve(stations.value).site_ids
+        measurements = read_measurements_df(spark, raw, site_ids)
+        if args.dedup != 'none':
+            measurements, records_in, records_out = dedup_station_hours_df(
+                measurements, args.dedup)
+        data_hourly = grid_hourly_df(measurements, stations)
+    else:
+        data_rdd = sc.textFile(','.join(raw))
+        print(data_rdd.count())
+        measurements = data_rdd\
+            .map(lambda line: parse_measurement_record(
+                line, station_table.resolve(stations.value)))\
+            .filter(lambda line: line is not None)
+
+        if args.dedup != 'none':
+            records_in_acc = sc.accumulator(0)
+            records_out_acc = sc.accumulator(0)
+            measurements = dedup_station_hours(measurements, args.dedup,
+                                               records_in_acc, records_out_acc)
+
+        # Compute hourly pollution levels on the grid
+        if args.engine == 'sparse':
+            # Shuffle only the station readings, grouped by hour and parameter
+            # output: (grid_id, parameter, timestamp, C)
+            hourly_records = measurements\
+                .map(lambda rdd: ((rdd[3], rdd[1]), (rdd[0], rdd[2])))\
+                .groupByKey()\
+                .flatMap(lambda group: idw_engine.interpolate_hour(
+                    group, station_table.resolve(stations.value)))
+        elif args.engine == 'fused':
+            # One geometry fan-out and one shuffle for all weather parameters
+            # output: (grid_id, parameter, timestamp, C)
+            hourly_records = measurements\
+                .map(station_hour_vector)\
+                .filter(lambda rdd: rdd is not None)\
+                .reduceByKey(add_vectors)\
+                .flatMap(lambda rdd: station_vector_to_grid(
+                    rdd, station_table.resolve(stations.value)))\
+                .reduceByKey(add_vectors)\
+                .flatMap(unpack_grid_vector)
+        else:
+            hourly_records = measurements\
+                .flatMap(lambda rdd: station_to_grid(
+                    rdd, station_table.resolve(stations.value)))\
+                .reduceByKey(sum_weight_and_prods)\
+                .map(calc_weighted_average_grid)
+        data_hourly = spark.createDataFrame(hourly_records, hourly_schema)
+
+    data_hourly = data_hourly.persist(StorageLevel.MEMORY_AND_DISK)
     print(data_hourly.count())
     print(data_hourly.take(5))
 
+    if args.dedup != 'none':
+        if args.ingest == 'rdd':
+            # Accumulators are complete once data_hourly has been counted
+            records_in, records_out = records_in_acc.value, records_out_acc.value
+        print('Station-hour readings: {} in, {} out, {} duplicates removed'
+              .format(records_in, records_out, records_in - records_out))
+
     # Write them to Cassandra database
-    #     .sort("grid_id")\
-    #     .write\
-    #     .format("org.apache.spark.sql.cassandra")\
-    #     .mode('append')\
-    #     .options(table="table_hourly", keyspace="air")\
-    #     .save()
-    # data_hourly_df = spark\
-    #     .createDataFrame(data_hourly, schema_hourly)\
-    #     .sort("grid_id")\
-    #     .withColumnRenamed("c", "measurement")\
-    #     .write\
-    #     .format("org.apache.spark.sql.cassandra")\
-    #     .mode('append')\
-    #     .options(table="table_hourly", keyspace="weather")\
-    #     .save()
-    # data_hourly_df = spark\
-    #     .createDataFrame(data_hourly, schema_hourly)\
-    #     .sort("grid_id")\
-    #     .write\
-    #     .mode("overwrite")\
-    #     .csv("s3a://epa-weather-history/hourly_PRESS_2021_cassandra")
-    # data_hourly.saveAsTextFile("s3a://epa-weather-history/hourly_PRESS_2021_cassandra")
-    # data_hourly_df = data_hourly.toDF()
-    # data_hourly_df.printSchema()
-    # data_hourly_df.show(5)
+    if args.hourly_sink == 'cassandra':
+        write_hourly_to_cassandra(data_hourly, args,
+                                  cassandra_username, cassandra_password)
 
     # Average pollution levels for each month
-    data_monthly = (data_hourly\
-        # output: ((grid_id, month_year, parameter), (C, 1))
-        .map(group_by_month)\
-        # divide the weighted concentrations by the sum of the weights
-        # output: (grid_id, parameter, timestamp, sum(weight*concentration)/sum(weight))
-        .reduceByKey(sum_weight_and_prods)\
-        # output: (grid_id, timestamp, parameter, C)
-        .map(average_over_month)\
-        .persist(StorageLevel.MEMORY_AND_DISK))
+    # output: (grid_id, time, parameter, C)
+    data_monthly = monthly_average_df(data_hourly)\
+        .persist(StorageLevel.MEMORY_AND_DISK)
 
     # Write monthly data to Postgres database
-    data_monthly_df = spark.createDataFrame(data_monthly, schema_monthly)
-    data_monthly_df.write.jdbc(
-        url=postgres_url, table=table_monthly,
-        mode='append', properties=postgres_credentials
-    )
+    if args.monthly_writer == 'copy':
+        batch_size = args.copy_batch_size
+
+        def write_partition(frames):
+            import pandas as pd
+
+            rows = bulk_load.write_monthly_partition(
+                frame_rows(frames, ['grid_id', 'time', 'parameter', 'c']),
+                postgres_dsn, batch_size)
+            yield pd.DataFrame({'rows': [rows]})
+
+        # repartition, not coalesce: a coalesce would also run the monthly
+        # aggregation in only copy_parallelism tasks. Partitioned by
+        # grid_id, so concurrent COPY tasks upsert disjoint grid points
+        # into grid_coverage and chart_series_dirty
+        copied = data_monthly\
+            .repartition(args.copy_parallelism, "grid_id")\
+            .mapInPandas(write_partition, 'rows long')\
+            .agg(F.sum('rows'))\
+            .first()[0]
+        print('Copied {} monthly records'.format(copied))
+    else:
+        # Plain JDBC inserts into a staging table, merged with one upsert
+        staging_monthly = table_monthly + '_staging_' + sc.applicationId\
+            .replace('-', '_').lower()
+        data_monthly.write.jdbc(
+            url=postgres_url, table=staging_monthly,
+            mode='overwrite', properties=postgres_credentials
+        )
+        conn = bulk_load.connect(postgres_dsn)
+        try:
+            cur = conn.cursor()
+            bulk_load.upsert_monthly(cur, staging_monthly)
+            cur.execute("DROP TABLE {};".format(staging_monthly))
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
+
+    # Whole-lattice rasters of every month and parameter, for map overlays
+    if args.rasters:
+        lattice = sc.broadcast(monthly_rasters.load_lattice(args.grid_index))
+        raster_location, raster_dtype = args.rasters, args.raster_dtype
+
+        rasters_monthly = data_monthly.groupBy("time", "parameter")
+        if monthly_rasters.is_s3(raster_location):
+            # Executors write straight to the shared bucket
+            written = rasters_monthly\
+                .applyInPandas(lambda frame: monthly_rasters.write_raster_frame(
+                    frame, lattice.value, raster_location, raster_dtype),
+                    schema='rasters long')\
+                .agg(F.sum('rasters'))\
+                .first()[0] or 0
+        else:
+            # A local directory only exists on the driver, so the rasters
+            # are streamed back and written there
+            written = 0
+            for row in rasters_monthly\
+                    .applyInPandas(lambda frame: monthly_rasters.serialize_raster_frame(
+                        frame, lattice.value, raster_dtype),
+                        schema='key string, npy binary')\
+                    .toLocalIterator():
+                monthly_rasters.save_npy(bytes(row.npy), raster_location, row.key)
+                written += 1
+        print('Wrote {} monthly rasters to {}'.format(written, raster_location))
+
+    # Materialize the dashboard series of the loaded grid points
+    bulk_load.refresh_chart_series(postgres_dsn)
 
 
 if __name__ == '__main__':
-    main(['hourly_WIND_2021.csv'])
+    main(sys.argv[1:] or ['hourly_WIND_2021.csv'])
@@ -0,0 +1,203 @@
+import os
+import json
+import tempfile
+
+import numpy as np
+
+
+# Files making up a station table directory
+FILES = ('site_ids', 'offsets', 'grid_ids', 'distances', 'weights')
+
+# Distances are stored rounded to 0.1 mile; a station closer to a grid point
+# than half of that is weighted as if it were this far (miles), so it
+# dominates the grid point instead of getting an infinite weight
+MIN_DISTANCE = 0.05
+
+
+class StationTable(object):
+    '''
+    Station to grid neighbor table in compressed sparse row (CSR) layout
+
+    Neighbors of the station at position i are grid_ids[offsets[i]:offsets[i+1]]
+    with the matching distances (miles, float32) and inverse distance
+    squared weights (float32). Each array is stored as its own .npy file so
+    the table can be memory-mapped instead of unpickled into Python objects.
+    '''
+
+    def __init__(self, site_ids, offsets, grid_ids, distances, weights):
+        self.site_ids = site_ids
+        self.offsets = offsets
+        self.grid_ids = grid_ids
+        self.distances = distances
+        self.weights = weights
+        self.site_index = {str(site_id): i for i, site_id in enumerate(site_ids)}
+        # Weight matrix, built on first use by idw_engine.weight_matrix
+        self.matrix = None
+
+    def __reduce__(self):
+        # Ship only the arrays (memory-mapped ones as plain arrays),
+        # the site index is rebuilt on the receiving side
+        return (StationTable, tuple(np.asarray(getattr(self, name))
+                                    for name in FILES))
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in FILES)
+
+    def __len__(self):
+        return len(self.site_ids)
+
+    def __contains__(self, site_id):
+        return site_id in self.site_index
+
+    def neighbors(self, site_id):
+        '''
+        Return (grid_ids, weights) arrays for a station
+
+        Parameters
+        ----------
+        site_id : str
+                    Station ID, e.g. '41|031|1002'
+
+        Returns
+        -------
+        tuple
+                    Views of the int32 grid ids and float32 weights
+        '''
+        i = self.site_index[site_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.grid_ids[start:end], self.weights[start:end]
+
+    @classmethod
+    def from_neighbors(cls, stations):
+        '''
+        Build a table from the {site_id: {grid_id: distance}} dict
+        produced by compile_stations.py
+
+        Parameters
+        ----------
+        stations : dict
+                    Keys are station IDs, values are dicts of grid ids
+                    (int or str) to distances in miles
+
+        Returns
+        -------
+        StationTable
+        '''
+        site_ids = sorted(stations)
+        counts = [len(stations[site_id]) for site_id in site_ids]
+        offsets = np.zeros(len(site_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        grid_ids = np.empty(offsets[-1], dtype=np.int32)
+        distances = np.empty(offsets[-1], dtype=np.float64)
+        for i, site_id in enumerate(site_ids):
+            grid = stations[site_id]
+            grid_ids[offsets[i]:offsets[i + 1]] = [int(g) for g in grid]
+            distances[offsets[i]:offsets[i + 1]] = list(grid.values())
+        # Weights come from the rounded float64 distances, like station_to_grid
+        weights = (1. / np.maximum(distances, MIN_DISTANCE) ** 2).astype(np.float32)
+        return cls(np.array(site_ids, dtype=np.str_), offsets, grid_ids,
+                   distances.astype(np.float32), weights)
+
+    def save(self, path):
+        '''
+        Write the table as a directory of .npy files
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in FILES:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load a table written by save, memory-mapping the arrays by default
+        '''
+        mmap_mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in FILES]
+        return cls(*arrays)
+
+
+def download_from_s3(bucketname, prefix, local_dir):
+    '''
+    Download a station table directory from S3
+
+    Parameters
+    ----------
+    bucketname : str
+                Name of the S3 bucket
+    prefix : str
+                Key prefix of the table directory, e.g. 'emr-data/stations_csr'
+    local_dir : str
+                Local directory to download the .npy files into
+    '''
+    import boto3
+
+    s3 = boto3.resource('s3')
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    for name in FILES:
+        fname = name + '.npy'
+        s3.Object(bucketname, prefix.rstrip('/') + '/' + fname)\
+            .download_file(os.path.join(local_dir, fname))
+
+
+def load_location(location, local_dir=None):
+    '''
+    Load a table from a local directory or an s3://bucket/prefix location
+
+    S3 tables are downloaded to local_dir (a temporary directory by default)
+    and memory-mapped from there.
+    '''
+    if location.startswith('s3://') or location.startswith('s3a://'):
+        bucketname, _, prefix = location.split('://', 1)[1].partition('/')
+        if local_dir is None:
+            local_dir = tempfile.mkdtemp(prefix='stations_csr_')
+        download_from_s3(bucketname, prefix, local_dir)
+        location = local_dir
+    return StationTable.load(location)
+
+
+# Tables loaded in this process, keyed by location. Spark reuses Python
+# workers, so a lazily broadcast table is loaded once per worker process
+# rather than once per task.
+_CACHE = {}
+
+
+def load_cached(location):
+    '''
+    Load a table once per process, see load_location
+    '''
+    table = _CACHE.get(location)
+    if table is None:
+        table = load_location(location)
+        _CACHE[location] = table
+    return table
+
+
+def resolve(value):
+    '''
+    Return the table behind a broadcast value, which is either the table
+    itself or the location to load it from on the executor
+    '''
+    if isinstance(value, StationTable):
+        return value
+    return load_cached(value)
+
+
+def convert_json(json_fname, path):
+    '''
+    Convert a stations.json neighbor file to a station table directory
+    '''
+    with open(json_fname, 'r') as f:
+        stations = json.load(f)
+    table = StationTable.from_neighbors(stations)
+    table.save(path)
+    return table
+
+
+if __name__ == '__main__':
+    # Usage: python station_table.py stations.json stations_csr
+    import sys
+    convert_json(sys.argv[1], sys.argv[2])